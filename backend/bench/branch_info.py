@@ -0,0 +1,213 @@
+"""
+Query count and wall time of `get_branch_info` on a deep conversation, next to
+the multi-query version it replaced. Every `fork_every` turns the user message
+gets a second answer, so the path has messages with siblings.
+
+    python -m bench.branch_info [turns] [fork_every] [runs]
+
+Runs on a throwaway SQLite database unless DB_URL is set.
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+from statistics import median
+from time import perf_counter
+from uuid import uuid4
+
+os.environ.setdefault(
+    "DB_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/branch_info.db"
+)
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.orm import selectinload  # noqa: E402
+from sqlmodel import asc, col, select  # noqa: E402
+
+from lib.db import (  # noqa: E402
+    BranchInfo,
+    DBConversation,
+    DBMessage,
+    DBUser,
+    MessageWithBranch,
+    _ancestor_rows,
+    engine,
+    get_branch_info,
+    get_conversation_context,
+    init,
+    session_factory,
+)
+from lib.errors import MessageNotFound  # noqa: E402
+
+queries = 0
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _count(*_):
+    global queries
+    queries += 1
+
+
+async def _get_message(id: str, session) -> DBMessage:
+    """The message lookup the previous version started with."""
+    statement = (
+        select(DBMessage)
+        .where(DBMessage.id == id)
+        .limit(1)
+        .options(
+            selectinload(DBMessage.conversation),  # type: ignore
+            selectinload(DBMessage.children),  # type: ignore
+        )
+    )
+    message = (await session.execute(statement)).scalar()
+    if not message:
+        raise MessageNotFound()
+
+    await session.refresh(message, ["conversation", "children"])
+    return message
+
+
+async def _previous_branch_info(last_message_id: str, session):
+    last_message = await _get_message(last_message_id, session)
+
+    current_path = last_message.path
+    if len(current_path) < 2:
+        messages = await get_conversation_context(last_message.id, session)
+        return [
+            MessageWithBranch(**message.model_dump(), branch=None)
+            for message in messages
+        ]
+
+    statement = (
+        select(DBMessage)
+        .where(col(DBMessage.id).in_(current_path))
+        .order_by(asc(DBMessage.created_at))
+    )
+    messages_in_branch = (await session.execute(statement)).scalars().all()
+
+    statement = (
+        select(DBMessage)
+        .where(col(DBMessage.parent_id).in_(current_path[:-1]))
+        .order_by(asc(DBMessage.created_at))
+    )
+    children = (await session.execute(statement)).scalars().all()
+
+    children_map: dict[str, list[str]] = {}
+    for child in children:
+        children_map.setdefault(child.parent_id or "", []).append(child.id)
+
+    result: list[MessageWithBranch] = []
+    for message in messages_in_branch:
+        siblings = children_map.get(message.id, [])
+        on_path = [index for index, id in enumerate(siblings) if id in current_path]
+        result.append(
+            MessageWithBranch(
+                **message.model_dump(),
+                branch=BranchInfo(total=siblings.__len__(), current=on_path[0] + 1)
+                if siblings.__len__() > 1 and on_path
+                else None,
+            )
+        )
+    return result
+
+
+async def _build(turns: int, fork_every: int) -> str:
+    started_at = datetime.now(timezone.utc)
+    user = DBUser(username=f"bench-{uuid4()}", password="")
+    conversation = DBConversation(user_id=user.id, model_id="bench")
+    messages: list[DBMessage] = []
+
+    def add(role: str, parent: DBMessage | None) -> DBMessage:
+        id = uuid4().__str__()
+        message = DBMessage(
+            id=id,
+            role=role,
+            content=f"{role} message " * 20,
+            reasoning=None,
+            conversation_id=conversation.id,
+            parent_id=parent.id if parent else None,
+            path=[*(parent.path if parent else []), id],
+            created_at=started_at + timedelta(milliseconds=messages.__len__()),
+        )
+        messages.append(message)
+        return message
+
+    head = add("system", None)
+    for turn in range(turns):
+        prompt = add("user", head)
+        if fork_every and turn % fork_every == 0:
+            add("assistant", prompt)
+        head = add("assistant", prompt)
+
+    async with session_factory() as session:
+        session.add(user)
+        await session.flush()
+        session.add(conversation)
+        await session.flush()
+        session.add_all(messages)
+        await session.flush()
+        for message in messages:
+            session.add_all(
+                _ancestor_rows(message.id, message.path, message.created_at)
+            )
+        await session.commit()
+
+    return head.id
+
+
+async def _measure(func, last_message_id: str, runs: int):
+    global queries
+    times: list[float] = []
+    result = []
+    for _ in range(runs):
+        async with session_factory() as session:
+            queries = 0
+            started_at = perf_counter()
+            result = await func(last_message_id, session)
+            times.append(perf_counter() - started_at)
+            count = queries
+    return result, {
+        "queries": count,
+        "median_ms": median(times) * 1000,
+        "max_ms": max(times) * 1000,
+    }
+
+
+async def main(turns: int, fork_every: int, runs: int):
+    await init()
+    last_message_id = await _build(turns, fork_every)
+
+    current, current_stats = await _measure(get_branch_info, last_message_id, runs)
+    previous, previous_stats = await _measure(
+        _previous_branch_info, last_message_id, runs
+    )
+    assert [(m.id, m.branch) for m in current] == [
+        (m.id, m.branch) for m in previous
+    ], "get_branch_info disagrees with the previous version"
+
+    print(
+        json.dumps(
+            {
+                "turns": turns,
+                "path_length": current.__len__(),
+                "branches": sum(1 for message in current if message.branch),
+                "single_statement": current_stats,
+                "previous": previous_stats,
+            },
+            indent=2,
+        )
+    )
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    asyncio.run(
+        main(
+            args[0] if args.__len__() > 0 else 500,
+            args[1] if args.__len__() > 1 else 10,
+            args[2] if args.__len__() > 2 else 20,
+        )
+    )
@@ -0,0 +1,64 @@
+"""
+Compare two `bench.load` reports route by route. Exits with 1 when a route's
+p95 latency or mean DB queries grew by more than the threshold (default 20%).
+
+    python -m bench.compare before.json after.json [threshold]
+"""
+
+import json
+import sys
+
+
+def _change(before: float | None, after: float | None) -> float | None:
+    if before is None or after is None or before == 0:
+        return None
+    return (after - before) / before
+
+
+def _format(before, after, change: float | None) -> str:
+    change_text = f"{change:+.0%}" if change is not None else "n/a"
+    return f"{before} -> {after} ({change_text})"
+
+
+def compare(before: dict, after: dict, threshold: float) -> list[str]:
+    regressions: list[str] = []
+    print(f"{before['meta']['commit']} -> {after['meta']['commit']}")
+    for route in sorted(set(before["routes"]) | set(after["routes"])):
+        old = before["routes"].get(route)
+        new = after["routes"].get(route)
+        if not old or not new:
+            print(f"{route}: only in {'after' if new else 'before'}")
+            continue
+
+        print(route)
+        for label, old_value, new_value in [
+            ("p50 ms", old["latency_ms"].get("p50"), new["latency_ms"].get("p50")),
+            ("p95 ms", old["latency_ms"].get("p95"), new["latency_ms"].get("p95")),
+            ("p99 ms", old["latency_ms"].get("p99"), new["latency_ms"].get("p99")),
+            ("rps", old["throughput_rps"], new["throughput_rps"]),
+            ("queries", old["db_queries"].get("mean"), new["db_queries"].get("mean")),
+            (
+                "lag p99 ms",
+                old["loop_lag_ms"].get("p99"),
+                new["loop_lag_ms"].get("p99"),
+            ),
+        ]:
+            change = _change(old_value, new_value)
+            print(f"  {label:<11} {_format(old_value, new_value, change)}")
+            if label in ("p95 ms", "queries") and change and change > threshold:
+                regressions.append(f"{route} {label}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    with open(sys.argv[1]) as file:
+        before = json.load(file)
+    with open(sys.argv[2]) as file:
+        after = json.load(file)
+    threshold = float(sys.argv[3]) if sys.argv.__len__() > 3 else 0.2
+
+    regressions = compare(before, after, threshold)
+    if regressions:
+        print("regressions: " + ", ".join(regressions))
+        sys.exit(1)
@@ -0,0 +1,210 @@
+"""
+Local stand-in for the upstream (ai.hackclub.com): `/model` and
+`/chat/completions`, plain or streamed, with configurable latency and answer
+size. Used by `bench.load`, or on its own to point a real server at it:
+
+    python -m bench.fake_upstream [--port 18080] [--latency 0.2] ...
+    UPSTREAM_URL=http://127.0.0.1:18080 fastapi run main.py
+"""
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+from dataclasses import dataclass, field
+
+from aiohttp import web
+
+# Start of the title system prompt (`lib.api._system_prompt`), leading
+# whitespace aside
+TITLE_PROMPT = "You are a title generator"
+FAKE_TITLE = "Fake title"
+# A last message `fault:<status>` is answered with that HTTP status, a streamed
+# answer to `fault:cut` / `fault:garbage` is cut / sends a broken chunk midway
+FAULT_PREFIX = "fault:"
+
+
+@dataclass
+class FakeUpstreamConfig:
+    models: list[str] = field(
+        default_factory=lambda: [
+            "qwen/qwen3-32b",
+            "openai/gpt-oss-120b",
+            "openai/gpt-oss-20b",
+            "meta-llama/llama-4-maverick-17b-128e-instruct",
+        ]
+    )
+    latency: float = 0.2  # seconds before the first byte of an answer
+    title_latency: float = 0.1
+    answer_bytes: int = 800
+    reasoning_bytes: int = 200
+    chunk_bytes: int = 16  # streamed answers are sent in chunks of this size
+    chunk_interval: float = 0.005
+
+
+def _text(prefix: str, size: int) -> str:
+    return (prefix + " lorem ipsum dolor sit amet" * (size // 26 + 1))[:size]
+
+
+def _usage(prompt_tokens: int, completion_tokens: int) -> dict:
+    return {
+        "completion_time": 0.1,
+        "completion_tokens": completion_tokens,
+        "prompt_time": 0.01,
+        "prompt_tokens": prompt_tokens,
+        "queue_time": 0.01,
+        "total_time": 0.11,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _completion(model: str, content: str, prompt_tokens: int) -> dict:
+    return {
+        "choices": [
+            {
+                "finish_reason": "stop",
+                "index": 0,
+                "logprobs": None,
+                "message": {"content": content, "role": "assistant"},
+            }
+        ],
+        "created": int(time.time()),
+        "id": "fake",
+        "model": model,
+        "object": "chat.completion",
+        "service_tier": "on_demand",
+        "system_fingerprint": "fake",
+        "usage": _usage(prompt_tokens, content.__len__() // 4),
+        "usage_breakdown": None,
+        "x_groq": {"id": "fake"},
+    }
+
+
+def _chunk(
+    model: str, delta: dict, finish_reason: str | None = None, usage: dict | None = None
+) -> bytes:
+    data = {
+        "id": "fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    if usage:
+        data["x_groq"] = {"id": "fake", "usage": usage}
+    return f"data: {json.dumps(data)}\n\n".encode()
+
+
+def make_app(config: FakeUpstreamConfig) -> web.Application:
+    async def models(request: web.Request) -> web.Response:
+        return web.Response(text=",".join(config.models))
+
+    async def chat(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        model = body["model"]
+        messages = body["messages"]
+        prompt_tokens = sum(message["content"].__len__() for message in messages) // 4
+        if messages[0]["content"].lstrip().startswith(TITLE_PROMPT):
+            await asyncio.sleep(config.title_latency)
+            return web.json_response(_completion(model, FAKE_TITLE, prompt_tokens))
+
+        fault = messages[-1]["content"].removeprefix(FAULT_PREFIX)
+        if fault.isdigit():
+            return web.json_response(
+                {"error": {"message": f"fake {fault}"}},
+                status=int(fault),
+                headers={"Retry-After": "7"} if fault == "429" else None,
+            )
+
+        await asyncio.sleep(config.latency)
+        text = "<think>{}</think>{}".format(
+            _text("thinking", config.reasoning_bytes),
+            _text("answer", config.answer_bytes),
+        )
+        if not body.get("stream"):
+            return web.json_response(_completion(model, text, prompt_tokens))
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await response.write(_chunk(model, {"role": "assistant", "content": ""}))
+        for start in range(0, text.__len__(), config.chunk_bytes):
+            piece = text[start : start + config.chunk_bytes]
+            await response.write(_chunk(model, {"content": piece}))
+            if start and fault == "cut":
+                assert request.transport
+                request.transport.close()
+                return response
+            if start and fault == "garbage":
+                await response.write(b"data: {not json\n\n")
+            if config.chunk_interval:
+                await asyncio.sleep(config.chunk_interval)
+        usage = _usage(prompt_tokens, text.__len__() // 4)
+        await response.write(_chunk(model, {}, "stop", usage))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_get("/model", models)
+    app.router.add_post("/chat/completions", chat)
+    return app
+
+
+class FakeUpstreamThread(threading.Thread):
+    """The fake upstream on its own event loop, so it does not load the app's."""
+
+    def __init__(self, config: FakeUpstreamConfig, host: str, port: int) -> None:
+        super().__init__(daemon=True, name="fake-upstream")
+        self.config = config
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        runner = web.AppRunner(make_app(self.config), access_log=None)
+        self.loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, self.host, self.port)
+        self.loop.run_until_complete(site.start())
+        self.ready.set()
+        self.loop.run_forever()
+        self.loop.run_until_complete(runner.cleanup())
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = FakeUpstreamConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency)
+    parser.add_argument("--title-latency", type=float, default=defaults.title_latency)
+    parser.add_argument("--answer-bytes", type=int, default=defaults.answer_bytes)
+    parser.add_argument("--reasoning-bytes", type=int, default=defaults.reasoning_bytes)
+    parser.add_argument("--chunk-bytes", type=int, default=defaults.chunk_bytes)
+    parser.add_argument("--chunk-interval", type=float, default=defaults.chunk_interval)
+
+
+def config_from_arguments(args: argparse.Namespace) -> FakeUpstreamConfig:
+    return FakeUpstreamConfig(
+        latency=args.latency,
+        title_latency=args.title_latency,
+        answer_bytes=args.answer_bytes,
+        reasoning_bytes=args.reasoning_bytes,
+        chunk_bytes=args.chunk_bytes,
+        chunk_interval=args.chunk_interval,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(make_app(config_from_arguments(args)), host=args.host, port=args.port)
@@ -0,0 +1,59 @@
+"""
+Event loop lag during a login burst, with argon2 run inline (as `verify_user`
+used to) and through the hash executor.
+
+    python -m bench.hash_loop_lag [logins]
+"""
+
+import asyncio
+import json
+import sys
+from time import perf_counter
+
+from lib.hash import argon2_hasher, hash_stats, verify_async
+
+
+async def _watch_lag(stop: asyncio.Event, interval: float = 0.001) -> list[float]:
+    lags: list[float] = []
+    while not stop.is_set():
+        started_at = perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(perf_counter() - started_at - interval)
+    return lags
+
+
+async def _inline_verify(hashed: str, password: str):
+    return argon2_hasher.verify(hashed, password)
+
+
+async def _burst(verify, hashed: str, logins: int) -> dict[str, float]:
+    stop = asyncio.Event()
+    watcher = asyncio.create_task(_watch_lag(stop))
+    await asyncio.sleep(0.01)
+
+    started_at = perf_counter()
+    await asyncio.gather(*(verify(hashed, "password123") for _ in range(logins)))
+    elapsed = perf_counter() - started_at
+
+    stop.set()
+    lags = sorted(await watcher)
+    return {
+        "wall_seconds": elapsed,
+        "lag_max_ms": lags[-1] * 1000,
+        "lag_p99_ms": lags[int(lags.__len__() * 0.99)] * 1000,
+    }
+
+
+async def main(logins: int):
+    hashed = argon2_hasher.hash("password123")
+    result = {
+        "logins": logins,
+        "inline": await _burst(_inline_verify, hashed, logins),
+        "executor": await _burst(verify_async, hashed, logins),
+        "executor_stats": hash_stats().model_dump(),
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if sys.argv.__len__() > 1 else 20))
@@ -0,0 +1,529 @@
+"""
+Load test of the whole app against a local fake upstream (`bench.fake_upstream`).
+`main.app` is served by uvicorn on its own thread and event loop, the fake
+upstream on another, and virtual users drive a weighted mix of login,
+conversation creation, prompts (plain and streamed), conversation fetches and
+listings from the main thread. Reports per route p50/p95/p99 latency,
+throughput, DB queries per request and the event loop lag seen while the route
+was in flight, as JSON:
+
+    python -m bench.load [--concurrency 20] [--duration 30] [--out run.json]
+    python -m bench.compare before.json after.json
+
+Runs on a throwaway SQLite database unless DB_URL is set (e.g. to a Postgres
+`postgresql+asyncpg://...` URL, with its driver installed).
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+from datetime import datetime, timezone
+from statistics import mean
+from time import perf_counter
+from typing import Any
+from uuid import uuid4
+
+import aiohttp
+
+from bench.fake_upstream import (
+    FAKE_TITLE,
+    FakeUpstreamThread,
+    add_arguments,
+    config_from_arguments,
+)
+
+DEFAULT_MIX = "login=1,create=1,prompt=3,stream=2,fetch=6,list=3"
+
+ROUTES = {
+    "login": "POST /user/login",
+    "create": "POST /ai/conversation",
+    "prompt": "POST /ai/prompt",
+    "stream": "POST /ai/prompt/stream",
+    "fetch": "GET /ai/conversation",
+    "list": "GET /ai/conversations/summary",
+}
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return values[min(int(values.__len__() * q), values.__len__() - 1)]
+
+    return {
+        "p50": at(0.50),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": values[-1],
+        "mean": mean(values),
+    }
+
+
+def _ms(values: list[float]) -> dict[str, float]:
+    return {key: round(value * 1000, 3) for key, value in percentiles(values).items()}
+
+
+"""
+SERVER SIDE
+
+Wraps the ASGI app to count the DB queries of every request and to attribute
+event loop lag to the routes in flight when it was measured.
+"""
+
+
+class ServerStats:
+    def __init__(self, lag_interval: float) -> None:
+        self.lag_interval = lag_interval
+        self.queries: dict[str, list[int]] = {}
+        self.lags: dict[str, list[float]] = {}
+        self.all_lags: list[float] = []
+        self.in_flight: dict[str, int] = {}
+        self.recording = False
+
+    def reset(self) -> None:
+        self.queries.clear()
+        self.lags.clear()
+        self.all_lags.clear()
+
+
+_request_queries: contextvars.ContextVar[list[int] | None] = contextvars.ContextVar(
+    "request_queries", default=None
+)
+
+
+class InstrumentedApp:
+    def __init__(self, app, stats: ServerStats) -> None:
+        self.app = app
+        self.stats = stats
+        self._watcher: asyncio.Task | None = None
+
+    async def _watch_lag(self) -> None:
+        interval = self.stats.lag_interval
+        while True:
+            started_at = perf_counter()
+            await asyncio.sleep(interval)
+            lag = perf_counter() - started_at - interval
+            if not self.stats.recording:
+                continue
+            self.stats.all_lags.append(lag)
+            for route, count in self.stats.in_flight.items():
+                if count:
+                    self.stats.lags.setdefault(route, []).append(lag)
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "lifespan" and not self._watcher:
+            self._watcher = asyncio.create_task(self._watch_lag())
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        route = f"{scope['method']} {scope['path'].rstrip('/') or '/'}"
+        counter = [0]
+        token = _request_queries.set(counter)
+        self.stats.in_flight[route] = self.stats.in_flight.get(route, 0) + 1
+        try:
+            await self.app(scope, receive, send)
+
+        finally:
+            self.stats.in_flight[route] -= 1
+            _request_queries.reset(token)
+            if self.stats.recording:
+                self.stats.queries.setdefault(route, []).append(counter[0])
+
+
+def _count_query(*_) -> None:
+    counter = _request_queries.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+"""
+CLIENT SIDE
+"""
+
+
+class ClientStats:
+    def __init__(self) -> None:
+        self.latencies: dict[str, list[float]] = {}
+        self.first_event: dict[str, list[float]] = {}
+        self.errors: dict[str, dict[str, int]] = {}
+        self.recording = False
+
+    def record(self, route: str, elapsed: float) -> None:
+        if self.recording:
+            self.latencies.setdefault(route, []).append(elapsed)
+
+    def error(self, route: str, reason: str) -> None:
+        if self.recording:
+            errors = self.errors.setdefault(route, {})
+            errors[reason] = errors.get(reason, 0) + 1
+
+
+class VirtualUser:
+    def __init__(
+        self,
+        http: aiohttp.ClientSession,
+        stats: ClientStats,
+        model_id: str,
+        prompt_bytes: int,
+    ) -> None:
+        self.http = http
+        self.stats = stats
+        self.model_id = model_id
+        self.content = ("load test prompt " * (prompt_bytes // 17 + 1))[:prompt_bytes]
+        self.username = f"load_{uuid4().hex[:16]}"
+        self.password = "password123"
+        self.token = ""
+        self.heads: dict[str, str] = {}  # conversation id -> latest message id
+        self.etags: dict[str, str] = {}
+
+    @property
+    def headers(self) -> dict[str, str]:
+        return {"Authorization": f"Bearer {self.token}"}
+
+    async def _request(self, route: str, method: str, path: str, **kwargs):
+        started_at = perf_counter()
+        async with self.http.request(method, path, **kwargs) as response:
+            body = await response.read()
+        elapsed = perf_counter() - started_at
+        if response.status >= 400:
+            self.stats.error(route, str(response.status))
+            return None, None
+        self.stats.record(route, elapsed)
+        return response, body
+
+    async def setup(self) -> None:
+        async with self.http.post(
+            "/user/", json={"username": self.username, "password": self.password}
+        ) as response:
+            response.raise_for_status()
+        await self.login()
+        await self.create()
+
+    async def login(self) -> None:
+        _, body = await self._request(
+            ROUTES["login"],
+            "POST",
+            "/user/login",
+            data={"username": self.username, "password": self.password},
+        )
+        if body:
+            self.token = json.loads(body)["access_token"]
+
+    async def create(self) -> None:
+        _, body = await self._request(
+            ROUTES["create"],
+            "POST",
+            "/ai/conversation",
+            json={"model_id": self.model_id, "content": self.content},
+            headers=self.headers,
+        )
+        if body:
+            data = json.loads(body)
+            self.heads[data["conversation"]["id"]] = data["model"]["id"]
+            title = data["conversation"]["title"]
+            if not data["title_pending"] and title != FAKE_TITLE:
+                self.stats.error(ROUTES["create"], "wrong title")
+
+    def _conversation(self) -> str:
+        return random.choice(list(self.heads))
+
+    async def prompt(self) -> None:
+        conversation_id = self._conversation()
+        _, body = await self._request(
+            ROUTES["prompt"],
+            "POST",
+            "/ai/prompt",
+            json={"message_id": self.heads[conversation_id], "content": self.content},
+            headers=self.headers,
+        )
+        if body:
+            self.heads[conversation_id] = json.loads(body)["model"]["id"]
+
+    async def stream(self) -> None:
+        route = ROUTES["stream"]
+        conversation_id = self._conversation()
+        started_at = perf_counter()
+        first_event: float | None = None
+        event = ""
+        async with self.http.post(
+            "/ai/prompt/stream",
+            json={"message_id": self.heads[conversation_id], "content": self.content},
+            headers=self.headers,
+        ) as response:
+            if response.status >= 400:
+                await response.read()
+                self.stats.error(route, str(response.status))
+                return
+
+            async for line in response.content:
+                line = line.decode().rstrip("\n")
+                if line.startswith("event: "):
+                    event = line.removeprefix("event: ")
+                elif line.startswith("data: "):
+                    if event == "delta" and first_event is None:
+                        first_event = perf_counter() - started_at
+                    elif event == "model":
+                        data = json.loads(line.removeprefix("data: "))
+                        self.heads[conversation_id] = data["id"]
+                    elif event == "error":
+                        self.stats.error(route, "stream error")
+                        return
+
+        self.stats.record(route, perf_counter() - started_at)
+        if first_event is not None and self.stats.recording:
+            self.stats.first_event.setdefault(route, []).append(first_event)
+
+    async def fetch(self) -> None:
+        conversation_id = self._conversation()
+        headers = self.headers
+        if conversation_id in self.etags:
+            headers["If-None-Match"] = self.etags[conversation_id]
+        response, _ = await self._request(
+            ROUTES["fetch"],
+            "GET",
+            "/ai/conversation",
+            params={"id": conversation_id},
+            headers=headers,
+        )
+        if response is not None and "ETag" in response.headers:
+            self.etags[conversation_id] = response.headers["ETag"]
+
+    async def list_conversations(self) -> None:
+        await self._request(
+            ROUTES["list"],
+            "GET",
+            "/ai/conversations/summary",
+            params={"limit": "50"},
+            headers=self.headers,
+        )
+
+    async def run(self, mix: dict[str, int], deadline: float) -> None:
+        handlers = {
+            "login": self.login,
+            "create": self.create,
+            "prompt": self.prompt,
+            "stream": self.stream,
+            "fetch": self.fetch,
+            "list": self.list_conversations,
+        }
+        actions = list(mix)
+        weights = [mix[action] for action in actions]
+        while perf_counter() < deadline:
+            action = random.choices(actions, weights)[0]
+            try:
+                await handlers[action]()
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                self.stats.error(ROUTES[action], type(error).__name__)
+
+
+"""
+RUN
+"""
+
+
+def _parse_mix(raw: str) -> dict[str, int]:
+    mix: dict[str, int] = {}
+    for item in raw.split(","):
+        action, _, weight = item.strip().partition("=")
+        if action not in ROUTES:
+            raise ValueError(f"unknown action {action!r} in mix")
+        mix[action] = int(weight or 1)
+    return mix
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _report(
+    args: argparse.Namespace,
+    mix: dict[str, int],
+    dialect: str,
+    elapsed: float,
+    client: ClientStats,
+    server: ServerStats,
+) -> dict[str, Any]:
+    routes: dict[str, Any] = {}
+    for route in ROUTES.values():
+        latencies = client.latencies.get(route, [])
+        errors = client.errors.get(route, {})
+        if not latencies and not errors:
+            continue
+        queries = server.queries.get(route, [])
+        routes[route] = {
+            "requests": latencies.__len__(),
+            "errors": errors,
+            "throughput_rps": round(latencies.__len__() / elapsed, 2),
+            "latency_ms": _ms(latencies),
+            "db_queries": {
+                "mean": round(mean(queries), 2),
+                "max": max(queries),
+            }
+            if queries
+            else {},
+            "loop_lag_ms": _ms(server.lags.get(route, [])),
+        }
+        if route in client.first_event:
+            routes[route]["first_event_ms"] = _ms(client.first_event[route])
+
+    requests = sum(route["requests"] for route in routes.values())
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "db": dialect,
+            "concurrency": args.concurrency,
+            "duration_seconds": round(elapsed, 3),
+            "warmup_seconds": args.warmup,
+            "mix": mix,
+            "prompt_bytes": args.prompt_bytes,
+            "upstream": vars(config_from_arguments(args)),
+        },
+        "total": {
+            "requests": requests,
+            "errors": sum(sum(route["errors"].values()) for route in routes.values()),
+            "throughput_rps": round(requests / elapsed, 2),
+            "loop_lag_ms": _ms(server.all_lags),
+        },
+        "routes": routes,
+    }
+
+
+async def _drive(
+    args: argparse.Namespace,
+    mix: dict[str, int],
+    base_url: str,
+    client: ClientStats,
+    server: ServerStats,
+    model_id: str,
+) -> float:
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(
+        base_url,
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=args.timeout),
+    ) as http:
+        users = [
+            VirtualUser(http, client, model_id, args.prompt_bytes)
+            for _ in range(args.concurrency)
+        ]
+        await asyncio.gather(*(user.setup() for user in users))
+
+        if args.warmup:
+            deadline = perf_counter() + args.warmup
+            await asyncio.gather(*(user.run(mix, deadline) for user in users))
+
+        server.reset()
+        client.recording = server.recording = True
+        started_at = perf_counter()
+        deadline = started_at + args.duration
+        await asyncio.gather(*(user.run(mix, deadline) for user in users))
+        elapsed = perf_counter() - started_at
+        client.recording = server.recording = False
+        return elapsed
+
+
+def main(args: argparse.Namespace) -> dict[str, Any]:
+    mix = _parse_mix(args.mix)
+    upstream = FakeUpstreamThread(
+        config_from_arguments(args), "127.0.0.1", args.upstream_port
+    )
+    upstream.start()
+    upstream.ready.wait()
+
+    # lib.env reads these on import. Virtual users prompt far more often than
+    # people do, so admission control is off unless set explicitly.
+    os.environ["UPSTREAM_URL"] = upstream.url
+    os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "0")
+    os.environ.setdefault("USER_MAX_GENERATIONS", "0")
+    os.environ.setdefault("MAX_GENERATIONS", "0")
+    os.environ.setdefault("DB_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/load.db")
+
+    import uvicorn
+    from sqlalchemy import event
+
+    from lib.catalog import model_catalog
+    from lib.db import engine
+    from main import app
+
+    event.listen(engine.sync_engine, "before_cursor_execute", _count_query)
+    server_stats = ServerStats(args.lag_interval)
+    server = uvicorn.Server(
+        uvicorn.Config(
+            InstrumentedApp(app, server_stats),
+            host="127.0.0.1",
+            port=args.port,
+            log_level="warning",
+        )
+    )
+    thread = threading.Thread(target=server.run, name="app", daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("app failed to start")
+        threading.Event().wait(0.05)
+
+    client_stats = ClientStats()
+    try:
+        elapsed = asyncio.run(
+            _drive(
+                args,
+                mix,
+                f"http://127.0.0.1:{args.port}",
+                client_stats,
+                server_stats,
+                args.model or model_catalog.ids()[0],
+            )
+        )
+
+    finally:
+        server.should_exit = True
+        thread.join()
+        upstream.stop()
+
+    return _report(args, mix, engine.dialect.name, elapsed, client_stats, server_stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--mix", default=DEFAULT_MIX)
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--prompt-bytes", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--lag-interval", type=float, default=0.005)
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--upstream-port", type=int, default=18080)
+    parser.add_argument("--out", default=None, help="also write the JSON here")
+    add_arguments(parser)
+
+    args = parser.parse_args()
+    report = json.dumps(main(args), indent=2)
+    print(report)
+    if args.out:
+        with open(args.out, "w") as file:
+            file.write(report + "\n")
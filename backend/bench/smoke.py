@@ -0,0 +1,375 @@
+"""
+Smoke checks of behaviours a load run does not show, against a local fake
+upstream (`bench.fake_upstream`). The app is served by uvicorn on the same event
+loop, so checks can also call it as a plain ASGI app. Exits with 1 if a check
+fails:
+
+    python -m bench.smoke [check ...]
+"""
+
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import traceback
+from typing import Awaitable, Callable, Mapping
+
+import aiohttp
+
+from bench.fake_upstream import (
+    FAKE_TITLE,
+    FAULT_PREFIX,
+    FakeUpstreamConfig,
+    FakeUpstreamThread,
+)
+
+APP_PORT = 18090
+UPSTREAM_PORT = 18091
+MODEL_ID = "qwen/qwen3-32b"
+
+
+class SmokeClient:
+    def __init__(self, session: aiohttp.ClientSession, base_url: str) -> None:
+        self.session = session
+        self.base_url = base_url
+        self.headers: dict[str, str] = {}
+
+    async def login(self, username: str, password: str = "password123") -> None:
+        await self.session.post(
+            f"{self.base_url}/user/",
+            json={"username": username, "password": password},
+        )
+        async with self.session.post(
+            f"{self.base_url}/user/login",
+            data={"username": username, "password": password},
+        ) as response:
+            token = (await response.json())["access_token"]
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    async def request(
+        self, method: str, path: str, **kwargs
+    ) -> tuple[int, Mapping[str, str], bytes]:
+        headers = {**self.headers, **kwargs.pop("headers", {})}
+        async with self.session.request(
+            method, f"{self.base_url}{path}", headers=headers, **kwargs
+        ) as response:
+            return response.status, response.headers, await response.read()
+
+    async def new_conversation(self, content: str = "hi") -> dict:
+        status, _, body = await self.request(
+            "POST",
+            "/ai/conversation",
+            json={"model_id": MODEL_ID, "content": content},
+        )
+        assert status == 200, (status, body)
+        return json.loads(body)
+
+
+Check = Callable[[SmokeClient], Awaitable[None]]
+CHECKS: dict[str, Check] = {}
+
+
+def check(func: Check) -> Check:
+    CHECKS[func.__name__] = func
+    return func
+
+
+async def _wait_for(predicate: Callable[[], bool], timeout: float = 5) -> bool:
+    async with asyncio.timeout(timeout):
+        while not predicate():
+            await asyncio.sleep(0.01)
+    return True
+
+
+"""
+CHECKS
+"""
+
+
+@check
+async def stream_slot_released_when_client_leaves(client: SmokeClient) -> None:
+    """A stream dropped before its first chunk gives its generation slot back."""
+    from starlette.requests import ClientDisconnect
+
+    from lib.limits import generation_limiter
+    from main import app
+
+    conversation = await client.new_conversation()
+    body = json.dumps(
+        {"message_id": conversation["model"]["id"], "content": "again"}
+    ).encode()
+
+    # The client is gone when the headers are sent: the body never starts
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            raise OSError("client disconnected")
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0", "spec_version": "2.4"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/ai/prompt/stream",
+        "raw_path": b"/ai/prompt/stream",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"127.0.0.1"),
+            (b"content-type", b"application/json"),
+            (b"content-length", str(body.__len__()).encode()),
+            *[
+                (name.lower().encode(), value.encode())
+                for name, value in client.headers.items()
+            ],
+        ],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", APP_PORT),
+    }
+    try:
+        await app(scope, receive, send)
+
+    except ClientDisconnect:
+        ...
+
+    assert generation_limiter.running == 0, "slot leaked, body never started"
+
+    # A real socket closed right after the request
+    _, writer = await asyncio.open_connection("127.0.0.1", APP_PORT)
+    writer.write(
+        b"POST /ai/prompt/stream HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+        + b"".join(
+            f"{name}: {value}\r\n".encode() for name, value in client.headers.items()
+        )
+        + b"Content-Type: application/json\r\n"
+        + f"Content-Length: {body.__len__()}\r\n\r\n".encode()
+        + body
+    )
+    await writer.drain()
+    await _wait_for(lambda: generation_limiter.running == 1)
+    writer.close()
+    await _wait_for(lambda: generation_limiter.running == 0)
+
+    status, _, answer = await client.request(
+        "POST",
+        "/ai/prompt/stream",
+        data=body,
+        headers={"Content-Type": "application/json"},
+    )
+    assert status == 200 and b"event: done" in answer, (status, answer[:200])
+
+
+@check
+async def usage_metrics_need_a_token(client: SmokeClient) -> None:
+    """Per-user usage is not served without `METRICS_TOKEN`, whatever is sent."""
+    from lib.env import METRICS_ENABLED, METRICS_TOKEN
+
+    status, _, _ = await client.request("GET", "/metrics/usage")
+    if not METRICS_ENABLED:
+        assert status == 404, status
+    elif METRICS_TOKEN:
+        assert status == 401, status
+    else:
+        assert status == 404, status
+        status, _, _ = await client.request(
+            "GET", "/metrics/usage", headers={"Authorization": "Bearer "}
+        )
+        assert status == 404, status
+
+
+@check
+async def invalid_cursors_are_rejected(client: SmokeClient) -> None:
+    """A cursor that does not decode to `[created_at, id]` is a 400, not a 500."""
+    for cursor in [
+        "not base64!",
+        "MTIz",  # 123
+        "WzEsMl0=",  # [1, 2]
+        "WyJ4Il0=",  # ["x"]
+        "WyJub3QgYSBkYXRlIiwgIngiXQ==",  # ["not a date", "x"]
+    ]:
+        for path in ("/ai/conversations", "/ai/conversations/summary"):
+            status, _, body = await client.request(
+                "GET", path, params={"cursor": cursor}
+            )
+            assert status == 400, (path, cursor, status, body)
+
+
+@check
+async def titles_come_from_the_title_call(client: SmokeClient) -> None:
+    """The fake upstream answers title prompts with its title, not a chat answer."""
+    conversation = await client.new_conversation("a first message to entitle")
+    status, _, body = await client.request(
+        "GET",
+        "/ai/conversation/title",
+        params={"id": conversation["conversation"]["id"], "wait": 5},
+    )
+    assert status == 200, (status, body)
+    assert json.loads(body)["title"] == FAKE_TITLE, body[:200]
+
+
+@check
+async def title_waits_hold_no_connection(client: SmokeClient) -> None:
+    """A client waiting for a title does not keep a pooled connection."""
+    from lib.db import engine
+
+    conversation = await client.new_conversation("a message with a slow title")
+    waiting = asyncio.create_task(
+        client.request(
+            "GET",
+            "/ai/conversation/title",
+            params={"id": conversation["conversation"]["id"], "wait": 5},
+        )
+    )
+    await asyncio.sleep(0.05)
+    assert not waiting.done(), "the title came before it could be waited on"
+    assert engine.pool.checkedout() == 0, engine.pool.checkedout()
+
+    status, _, body = await waiting
+    assert status == 200 and json.loads(body)["title"] == FAKE_TITLE, body[:200]
+
+
+@check
+async def upstream_statuses_are_passed_on(client: SmokeClient) -> None:
+    """Upstream 429 and 4xx reach the client as such, 5xx as a 502."""
+    conversation = await client.new_conversation()
+    for fault, expected in (("429", 429), ("400", 400), ("422", 422), ("500", 502)):
+        status, headers, body = await client.request(
+            "POST",
+            "/ai/prompt",
+            json={
+                "message_id": conversation["model"]["id"],
+                "content": f"{FAULT_PREFIX}{fault}",
+            },
+        )
+        assert status == expected, (fault, status, body)
+        if fault == "429":
+            assert headers["Retry-After"] == "7", headers
+            assert json.loads(body)["detail"]["reason"] == "upstream", body
+
+
+@check
+async def broken_streams_end_with_an_error_event(client: SmokeClient) -> None:
+    """A stream cut or garbled by the upstream ends with `event: error`."""
+    conversation = await client.new_conversation()
+    for fault in ("cut", "garbage"):
+        status, _, answer = await client.request(
+            "POST",
+            "/ai/prompt/stream",
+            json={
+                "message_id": conversation["model"]["id"],
+                "content": f"{FAULT_PREFIX}{fault}",
+            },
+        )
+        assert status == 200, (fault, status, answer[:200])
+        assert b"event: delta" in answer, (fault, answer[:200])
+        assert answer.endswith(
+            b'event: error\ndata: {"message": "upstream unavailable"}\n\n'
+        ), (fault, answer[-200:])
+
+
+@check
+async def conversation_list_etags_follow_writes(client: SmokeClient) -> None:
+    """List ETags give 304s until a conversation is created, changed or deleted."""
+
+    async def etag_of(path: str, etag: str | None = None) -> tuple[int, str]:
+        status, headers, _ = await client.request(
+            "GET", path, headers={"If-None-Match": etag} if etag else {}
+        )
+        return status, headers["ETag"]
+
+    for path in ("/ai/conversations", "/ai/conversations/summary"):
+        _, etag = await etag_of(path)
+        conversation = await client.new_conversation()
+        status, new_etag = await etag_of(path, etag)
+        assert status == 200 and new_etag != etag, (path, "create", status)
+        assert (await etag_of(path, new_etag))[0] == 304, (path, "unchanged")
+
+        etag = new_etag
+        status, _, _ = await client.request(
+            "POST",
+            "/ai/prompt",
+            json={"message_id": conversation["model"]["id"], "content": "more"},
+        )
+        assert status == 200, status
+        status, etag = await etag_of(path, etag)
+        assert status == 200, (path, "prompt", status)
+
+        status, _, _ = await client.request(
+            "DELETE",
+            "/ai/conversation",
+            params={"id": conversation["conversation"]["id"]},
+        )
+        assert status == 200, status
+        status, _ = await etag_of(path, etag)
+        assert status == 200, (path, "delete", status)
+
+
+"""
+RUN
+"""
+
+
+async def _run(names: list[str]) -> int:
+    import uvicorn
+
+    from main import app
+
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=APP_PORT, log_level="warning")
+    )
+    serving = asyncio.create_task(server.serve())
+    await _wait_for(lambda: server.started, timeout=30)
+
+    failed = 0
+    try:
+        async with aiohttp.ClientSession() as session:
+            for index, name in enumerate(names):
+                client = SmokeClient(session, f"http://127.0.0.1:{APP_PORT}")
+                await client.login(f"smoke{index}")
+                try:
+                    await CHECKS[name](client)
+
+                except Exception:
+                    failed += 1
+                    print(f"FAIL {name}")
+                    traceback.print_exc()
+
+                else:
+                    print(f"ok   {name}")
+
+    finally:
+        server.should_exit = True
+        await serving
+
+    return failed
+
+
+def main(names: list[str]) -> int:
+    upstream = FakeUpstreamThread(
+        FakeUpstreamConfig(latency=0.05, title_latency=0.3, chunk_interval=0),
+        "127.0.0.1",
+        UPSTREAM_PORT,
+    )
+    upstream.start()
+    upstream.ready.wait()
+
+    # lib.env reads these on import
+    os.environ["UPSTREAM_URL"] = upstream.url
+    os.environ.setdefault(
+        "DB_URL", f"sqlite+aiosqlite:///{tempfile.mkdtemp()}/smoke.db"
+    )
+    os.environ.setdefault("USER_MAX_GENERATIONS", "1")
+    os.environ.setdefault("RATE_LIMIT_PER_MINUTE", "0")
+    try:
+        return asyncio.run(_run(names or list(CHECKS)))
+
+    finally:
+        upstream.stop()
+
+
+if __name__ == "__main__":
+    sys.exit(1 if main(sys.argv[1:]) else 0)
@@ -1,23 +1,56 @@
+import json
+import logging
 import re
-from asyncio import Timeout
-from typing import Any
+from asyncio import Task, create_task, gather, shield, wait_for
+from typing import Any, AsyncGenerator
 
-from aiohttp import ClientSession
+from aiohttp import ClientPayloadError
 from pydantic import BaseModel, Field
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from lib.cache import LRUCache
+from lib.catalog import model_catalog
+from lib.completions import (
+    completion_cache,
+    completion_key,
+    load as load_completions,
+    save as save_completions,
+    start as start_saving_completions,
+    stop as stop_saving_completions,
+)
+from lib.context import Context, context_bytes, fit_context, make_entry
 from lib.db import (
     BaseConversation,
-    BaseMessage,
+    DBMessage,
+    MessageUsage,
     MessageWithId,
     MessageWithReasoning,
     create_new_conversation,
     create_session_and_run,
     follow_up,
     get_conversation_context,
+    has_children,
+    record_usage,
     update_conversation_title,
 )
-from lib.errors import EmptyResponse, ModelNotFound, WrongModel
+from lib.env import COMPLETION_CACHE_TITLES, CONTEXT_CACHE_BYTES
+from lib.errors import (
+    EmptyResponse,
+    ModelNotFound,
+    RateLimited,
+    UpstreamBusy,
+    UpstreamUnavailable,
+    WrongModel,
+)
+from lib.metrics import current_request, observe_usage
+from lib.upstream import (
+    CHAT_TIMEOUT,
+    TITLE_TIMEOUT,
+    Priority,
+    close as upstream_close,
+    init as upstream_init,
+    request as upstream_request,
+)
 
 
 class APIMessageReponse(BaseModel):
@@ -60,8 +93,39 @@ class APIReponse(BaseModel):
     x_groq: APIXGroqResponse
 
 
+class APIDeltaReponse(BaseModel):
+    content: str | None = Field(default=None)
+    reasoning: str | None = Field(default=None)
+    role: str | None = Field(default=None)
+
+
+class APIStreamChoicesReponse(BaseModel):
+    delta: APIDeltaReponse
+    finish_reason: str | None = Field(default=None)
+    index: int
+
+
+class APIStreamReponse(BaseModel):
+    choices: list[APIStreamChoicesReponse]
+    id: str
+    model: str
+    x_groq: Any = Field(default=None)
+
+
+def stream_usage(chunk: APIStreamReponse) -> APIUsageReponse | None:
+    """The upstream sends the usage of a stream in `x_groq` of its last chunk."""
+    if isinstance(chunk.x_groq, dict) and isinstance(chunk.x_groq.get("usage"), dict):
+        return APIUsageReponse(**chunk.x_groq["usage"])
+    return None
+
+
 class UserPrompt(BaseModel):
     content: str
+    cache: bool = Field(
+        default=False,
+        description="Reuse the answer given to the same messages on the same "
+        "model, if any, and remember this one",
+    )
 
 
 class CreateConversationRequest(UserPrompt):
@@ -77,89 +141,226 @@ class SendPromptResponse(BaseModel):
 
 class CreateConversationResponse(SendPromptResponse):
     conversation: BaseConversation
+    title_pending: bool = Field(default=False)
+
+
+class ConversationTitle(BaseModel):
+    id: str
+    title: str
+    pending: bool
+
+
+class StreamDelta(BaseModel):
+    content: str = Field(default="")
+    reasoning: str = Field(default="")
+
+
+StreamEvent = tuple[str, BaseModel]
 
 
-session: ClientSession
-model_list: list[str] = [
-    "qwen/qwen3-32b",
-    "openai/gpt-oss-120b",
-    "openai/gpt-oss-20b",
-    "meta-llama/llama-4-maverick-17b-128e-instruct",
-]
 reasoning_regex = re.compile(r"^<think>([\s\S]+)<\/think>([\s\S]+)$")
+logger = logging.getLogger(__name__)
 
 
 async def init() -> None:
-    global session, model_list
-    session = ClientSession("https://ai.hackclub.com")
+    await upstream_init()
+    await load_completions()
+    start_saving_completions()
+    model_catalog.start()
+
+
+async def close() -> None:
+    tasks = list(_title_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await gather(*tasks, return_exceptions=True)
+
+    await model_catalog.stop()
+    await upstream_close()
+    await stop_saving_completions()
+    await save_completions()
+
+
+"""
+TITLE
+"""
 
+_title_tasks: dict[str, Task[str]] = {}
+
+
+async def _generate_title(conversation_id: str, message: str) -> str:
+    # Runs on past the request that scheduled it, do not count against it
+    current_request.set(None)
     try:
-        async with Timeout(5):
-            async with session.get("/model") as response:
-                model_list = (await response.text()).split(",")
+        title, model_id, usage = await entitle_message(message)
+        await update_conversation_title(conversation_id, title)
+        if usage:
+            await record_usage(
+                conversation_id, model_id, "title", MessageUsage(**usage.model_dump())
+            )
+        return title
 
-    except TimeoutError:
-        ...
+    except (UpstreamBusy, RateLimited):
+        logger.warning("upstream busy, no title for conversation %s", conversation_id)
+        return ""
 
+    except Exception:
+        logger.exception("cannot generate title of conversation %s", conversation_id)
+        return ""
+
+    finally:
+        _title_tasks.pop(conversation_id, None)
+
+
+def schedule_title(conversation_id: str, message: str) -> Task[str]:
+    """
+    Generate and save the title of a conversation in the background, so it does
+    not wait for (or delay) the first answer. It uses its own session.
+    """
+    task = create_task(_generate_title(conversation_id, message))
+    _title_tasks[conversation_id] = task
+    return task
+
+
+def title_pending(conversation_id: str) -> bool:
+    return conversation_id in _title_tasks
 
-async def close() -> None:
-    await session.close()
+
+async def wait_title(conversation_id: str, timeout: float) -> str | None:
+    """Wait at most `timeout` seconds for a pending title, `None` on timeout."""
+    task = _title_tasks.get(conversation_id)
+    if not task:
+        return None
+
+    try:
+        return await wait_for(shield(task), timeout)
+
+    except TimeoutError:
+        return None
 
 
 async def create_conversation(
-    user_id: str, model_id: str, message: str, session: AsyncSession | None = None
+    user_id: str,
+    model_id: str,
+    message: str,
+    session: AsyncSession | None = None,
+    cache: bool = False,
 ):
-    if model_id not in model_list:
+    if model_id not in model_catalog:
         raise ModelNotFound()
 
     async def _iner(session: AsyncSession):
         (new_conversation, new_message) = await create_new_conversation(
             user_id, model_id, session
         )
-        await update_conversation_title(
-            new_conversation.id, await entitle_message(message), session
-        )
-        model_reponse = await send_prompt(new_message.id, message, session)
+        title_task = schedule_title(new_conversation.id, message)
+        model_reponse = await send_prompt(new_message.id, message, session, cache=cache)
+        if title_task.done():
+            new_conversation.title = title_task.result()
         return CreateConversationResponse(
-            conversation=new_conversation, **model_reponse.model_dump()
+            conversation=new_conversation,
+            title_pending=not title_task.done(),
+            **model_reponse.model_dump(),
         )
 
     return await create_session_and_run(_iner, session)
 
 
+async def prompt_priority(
+    follow_message: DBMessage, session: AsyncSession | None = None
+) -> Priority:
+    """
+    A prompt following a message that was already answered by one is an edited
+    or re-asked prompt, any other is a new turn, on whichever branch.
+    """
+    if await has_children(follow_message.id, session):
+        return Priority.REGENERATION
+    return Priority.INTERACTIVE
+
+
 async def send_prompt(
-    follow_message_id: str, message: str, session: AsyncSession | None = None
+    follow_message: str | DBMessage,
+    message: str,
+    session: AsyncSession | None = None,
+    priority: Priority = Priority.INTERACTIVE,
+    cache: bool = False,
 ) -> SendPromptResponse:
     async def _iner(session: AsyncSession):
         user_message = await follow_up(
-            follow_message_id,
+            follow_message,
             MessageWithReasoning(content=message, role="user", reasoning=None),
             session,
         )
         return SendPromptResponse(
             user=MessageWithId(**user_message.model_dump()),
-            model=await _send_prompt(user_message, user_message.conversation, session)
+            model=await _send_prompt(
+                user_message, user_message.conversation, session, priority, cache
+            ),
         )
 
     return await create_session_and_run(_iner, session)
 
 
-async def _send_prompt(
-    user_message: MessageWithId, conversation: BaseConversation, _session: AsyncSession
-):
-    global session
+"""
+CONTEXT
+"""
 
-    context = await get_conversation_context(user_message.id)
-    send_data: dict[str, Any] = {
-        "messages": [
-            BaseMessage(**message.model_dump()).model_dump() for message in context
-        ],
-        "model": conversation.model_id,
-    }
-    async with session.post("/chat/completions", json=send_data) as response:
+# Message id -> the serialized messages on the path ending at that message. A
+# path never changes once written, so the context of a message is the one of
+# its parent plus one entry (entries are shared, the size is an upper bound).
+# What is actually sent is decided by `fit_context`.
+context_cache: LRUCache[str, Context] = LRUCache(
+    max_bytes=CONTEXT_CACHE_BYTES, sizeof=context_bytes
+)
+
+
+def _extend_context(parent_context: Context, message: MessageWithId) -> Context:
+    context = parent_context + (make_entry(message.role, message.content),)
+    context_cache.set(message.id, context)
+    return context
+
+
+async def get_context_payload(message: DBMessage) -> Context:
+    if message.parent_id:
+        parent_context = context_cache.get(message.parent_id)
+        if parent_context is not None:
+            return _extend_context(parent_context, message)
+
+    messages = await get_conversation_context(message.id)
+    context = tuple(make_entry(item.role, item.content) for item in messages)
+    context_cache.set(message.id, context)
+    return context
+
+
+def _build_send_data(context: bytes, model_id: str, stream: bool = False) -> bytes:
+    return b"".join(
+        [
+            b'{"messages":[',
+            context,
+            b'],"model":',
+            json.dumps(model_id).encode(),
+            b',"stream":true}' if stream else b"}",
+        ]
+    )
+
+
+async def _complete(
+    send_data: bytes, model_id: str, priority: Priority
+) -> tuple[MessageWithReasoning, APIUsageReponse]:
+    async with upstream_request(
+        "POST",
+        "/chat/completions",
+        "chat",
+        CHAT_TIMEOUT,
+        model=model_id,
+        priority=priority,
+        data=send_data,
+        headers={"Content-Type": "application/json"},
+    ) as response:
         resp_data = APIReponse(**(await response.json()))
-        if resp_data.model != conversation.model_id:
+        if resp_data.model != model_id:
             raise WrongModel()
+        observe_usage(resp_data.model, resp_data.usage)
 
         try:
             model_response_message_raw = resp_data.choices[0].message
@@ -176,14 +377,278 @@ async def _send_prompt(
             )[0]
             model_response_message.reasoning = reasoning
             model_response_message.content = content
-        model_response_message_db = await follow_up(
-            user_message.id, model_response_message, _session
+        return model_response_message, resp_data.usage
+
+
+def _chat_cache_key(messages: bytes, model_id: str) -> str | None:
+    return completion_key(model_id, json.loads(b"[" + messages + b"]"))
+
+
+async def _send_prompt(
+    user_message: DBMessage,
+    conversation: BaseConversation,
+    _session: AsyncSession,
+    priority: Priority = Priority.INTERACTIVE,
+    cache: bool = False,
+):
+    context = await get_context_payload(user_message)
+    messages = fit_context(context, conversation.model_id)
+    cache_key = _chat_cache_key(messages, conversation.model_id) if cache else None
+    model_response_message = completion_cache.get(cache_key) if cache_key else None
+    usage: APIUsageReponse | None = None
+    if model_response_message is None:
+        model_response_message, usage = await _complete(
+            _build_send_data(messages, conversation.model_id),
+            conversation.model_id,
+            priority,
         )
-        return MessageWithId(
-            id=model_response_message_db.id,
-            content=model_response_message_db.content,
-            reasoning=model_response_message_db.reasoning,
-            role=model_response_message_db.role,
+        if cache_key:
+            completion_cache.set(cache_key, model_response_message)
+
+    model_response_message_db = await follow_up(
+        user_message.id,
+        model_response_message,
+        _session,
+        usage=MessageUsage(**usage.model_dump()) if usage else None,
+    )
+    _extend_context(context, model_response_message_db)
+    return MessageWithId(
+        id=model_response_message_db.id,
+        content=model_response_message_db.content,
+        reasoning=model_response_message_db.reasoning,
+        role=model_response_message_db.role,
+    )
+
+
+class ReasoningSplitter:
+    """
+    Streaming counterpart of `reasoning_regex`: split a completion that starts
+    with `<think>...</think>` into reasoning and content while chunks arrive.
+    Tags cut between two chunks are held back until they can be decided.
+    """
+
+    _open_tag = "<think>"
+    _close_tag = "</think>"
+
+    def __init__(self) -> None:
+        self._buffer = ""
+        self._state = "start"  # start -> reasoning -> content
+
+    @staticmethod
+    def _partial_tag(text: str, tag: str) -> int:
+        for size in range(min(len(text), len(tag) - 1), 0, -1):
+            if text.endswith(tag[:size]):
+                return size
+        return 0
+
+    def feed(self, chunk: str) -> StreamDelta:
+        self._buffer += chunk
+        delta = StreamDelta()
+
+        if self._state == "start":
+            if self._buffer.startswith(self._open_tag):
+                self._buffer = self._buffer[len(self._open_tag) :]
+                self._state = "reasoning"
+            elif self._open_tag.startswith(self._buffer):
+                return delta
+            else:
+                self._state = "content"
+
+        if self._state == "reasoning":
+            index = self._buffer.find(self._close_tag)
+            if index == -1:
+                keep = self._partial_tag(self._buffer, self._close_tag)
+                delta.reasoning = self._buffer[: len(self._buffer) - keep]
+                self._buffer = self._buffer[len(self._buffer) - keep :]
+                return delta
+
+            delta.reasoning = self._buffer[:index]
+            self._buffer = self._buffer[index + len(self._close_tag) :]
+            self._state = "content"
+
+        delta.content, self._buffer = self._buffer, ""
+        return delta
+
+    def flush(self) -> StreamDelta:
+        rest, self._buffer = self._buffer, ""
+        if self._state == "reasoning":
+            return StreamDelta(reasoning=rest)
+        return StreamDelta(content=rest)
+
+
+async def _iter_stream_chunks(
+    send_data: bytes, model_id: str, priority: Priority = Priority.INTERACTIVE
+) -> AsyncGenerator[APIStreamReponse, None]:
+    async with upstream_request(
+        "POST",
+        "/chat/completions",
+        "chat_stream",
+        CHAT_TIMEOUT,
+        model=model_id,
+        priority=priority,
+        data=send_data,
+        headers={"Content-Type": "application/json"},
+    ) as response:
+        try:
+            async for raw_line in response.content:
+                line = raw_line.decode().strip()
+                if not line.startswith("data:"):
+                    continue
+
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+
+                yield APIStreamReponse(**json.loads(data))
+
+        # The stream was cut or sent something else than a chunk: the answer is
+        # lost either way, and the client gets an `error` event
+        except (ClientPayloadError, ValueError, TypeError) as error:
+            logger.warning("upstream stream broke off: %r", error)
+            raise UpstreamUnavailable() from error
+
+
+async def _iter_cached_chunks(
+    message: MessageWithReasoning, model_id: str
+) -> AsyncGenerator[APIStreamReponse, None]:
+    """A cached answer, as the one chunk the upstream would have streamed."""
+    yield APIStreamReponse(
+        choices=[
+            APIStreamChoicesReponse(
+                delta=APIDeltaReponse(
+                    content=message.content,
+                    reasoning=message.reasoning,
+                    role=message.role,
+                ),
+                finish_reason="stop",
+                index=0,
+            )
+        ],
+        id="cached",
+        model=model_id,
+    )
+
+
+async def stream_prompt(
+    follow_message: str | DBMessage,
+    message: str,
+    priority: Priority = Priority.INTERACTIVE,
+    cache: bool = False,
+) -> AsyncGenerator[StreamEvent, None]:
+    """
+    Same as `send_prompt` but yields `(event, payload)` pairs as soon as they are
+    available: `user` once the prompt is saved, `delta` for every piece of
+    reasoning / content, and `model` once the full answer has been saved. A
+    cached answer comes as a single `delta`.
+
+    It always opens its own session, the request session is already closed
+    when a streaming response starts.
+    """
+
+    async def _iner(session: AsyncSession):
+        user_message = await follow_up(
+            follow_message,
+            MessageWithReasoning(content=message, role="user", reasoning=None),
+            session,
+        )
+        return user_message, user_message.conversation
+
+    user_message, conversation = await create_session_and_run(_iner)
+    yield "user", MessageWithId(**user_message.model_dump())
+
+    context = await get_context_payload(user_message)
+    messages = fit_context(context, conversation.model_id)
+    cache_key = _chat_cache_key(messages, conversation.model_id) if cache else None
+    cached = completion_cache.get(cache_key) if cache_key else None
+    chunks = (
+        _iter_cached_chunks(cached, conversation.model_id)
+        if cached
+        else _iter_stream_chunks(
+            _build_send_data(messages, conversation.model_id, stream=True),
+            conversation.model_id,
+            priority,
+        )
+    )
+    splitter = ReasoningSplitter()
+    role = "assistant"
+    reasoning = ""
+    content = ""
+    usage: APIUsageReponse | None = None
+    async for chunk in chunks:
+        if chunk.model != conversation.model_id:
+            raise WrongModel()
+
+        usage = stream_usage(chunk) or usage
+
+        if not chunk.choices:
+            continue
+
+        delta = chunk.choices[0].delta
+        role = delta.role or role
+        stream_delta = splitter.feed(delta.content or "")
+        stream_delta.reasoning = (delta.reasoning or "") + stream_delta.reasoning
+        if stream_delta.content or stream_delta.reasoning:
+            reasoning += stream_delta.reasoning
+            content += stream_delta.content
+            yield "delta", stream_delta
+
+    stream_delta = splitter.flush()
+    if stream_delta.content or stream_delta.reasoning:
+        reasoning += stream_delta.reasoning
+        content += stream_delta.content
+        yield "delta", stream_delta
+
+    if not content and not reasoning:
+        raise EmptyResponse()
+
+    if usage:
+        observe_usage(conversation.model_id, usage)
+    model_message = MessageWithReasoning(
+        content=content, reasoning=reasoning or None, role=role
+    )
+    if cache_key and not cached:
+        completion_cache.set(cache_key, model_message)
+    model_message_db = await follow_up(
+        user_message.id,
+        model_message,
+        usage=MessageUsage(**usage.model_dump()) if usage else None,
+    )
+    _extend_context(context, model_message_db)
+    yield "model", MessageWithId(
+        id=model_message_db.id,
+        content=model_message_db.content,
+        reasoning=model_message_db.reasoning,
+        role=model_message_db.role,
+    )
+
+
+async def stream_conversation(
+    user_id: str, model_id: str, message: str, cache: bool = False
+) -> AsyncGenerator[StreamEvent, None]:
+    """
+    Same as `create_conversation` but streams the first answer, see
+    `stream_prompt`. A `conversation` event is sent before anything else and a
+    `title` event as soon as the title is generated.
+    """
+    if model_id not in model_catalog:
+        raise ModelNotFound()
+
+    new_conversation, new_message = await create_new_conversation(user_id, model_id)
+    title_task = schedule_title(new_conversation.id, message)
+    yield "conversation", new_conversation
+
+    title_sent = False
+    async for event in stream_prompt(new_message.id, message, cache=cache):
+        yield event
+        if not title_sent and title_task.done():
+            title_sent = True
+            yield "title", ConversationTitle(
+                id=new_conversation.id, title=title_task.result(), pending=False
+            )
+
+    if not title_sent:
+        yield "title", ConversationTitle(
+            id=new_conversation.id, title=await shield(title_task), pending=False
         )
 
 
@@ -203,7 +668,11 @@ Title: "Understanding SQL Joins"
 """
 
 
-async def entitle_message(message: str):
+async def entitle_message(message: str) -> tuple[str, str, APIUsageReponse | None]:
+    """
+    Title of a first message, with the model and usage of the call. Titles are
+    cached (`COMPLETION_CACHE_TITLES`), a cached one has no usage.
+    """
     send_data: dict[str, Any] = {
         "messages": [
             {"role": "system", "content": _system_prompt},
@@ -211,11 +680,36 @@ async def entitle_message(message: str):
         ],
         "model": "openai/gpt-oss-20b",
     }
-    async with session.post("/chat/completions", json=send_data) as response:
+    cache_key = (
+        completion_key(send_data["model"], send_data["messages"])
+        if COMPLETION_CACHE_TITLES
+        else None
+    )
+    cached = completion_cache.get(cache_key) if cache_key else None
+    if cached:
+        return cached.content, send_data["model"], None
+
+    async with upstream_request(
+        "POST",
+        "/chat/completions",
+        "title",
+        TITLE_TIMEOUT,
+        model=send_data["model"],
+        priority=Priority.BACKGROUND,
+        json=send_data,
+    ) as response:
         resp_data = APIReponse(**(await response.json()))
+        observe_usage(resp_data.model, resp_data.usage)
 
         try:
-            return resp_data.choices[0].message.content
+            title = resp_data.choices[0].message.content
 
         except IndexError:
             raise EmptyResponse()
+
+        if cache_key:
+            completion_cache.set(
+                cache_key,
+                MessageWithReasoning(content=title, role="assistant", reasoning=None),
+            )
+        return title, resp_data.model, resp_data.usage
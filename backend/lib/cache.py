@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from time import monotonic
+from typing import Callable, Generic, Hashable, TypeVar
+
+from pydantic import BaseModel, computed_field
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class CacheStats(BaseModel):
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    items: int
+    bytes: int
+    max_items: int | None
+    max_bytes: int | None
+    ttl: float | None
+
+    @computed_field
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+
+class LRUCache(Generic[K, V]):
+    """
+    In-process LRU cache bounded by item count and / or total size, `sizeof`
+    tells how many bytes a value takes. With `ttl`, entries older than `ttl`
+    seconds are dropped on lookup.
+    """
+
+    def __init__(
+        self,
+        max_items: int | None = None,
+        max_bytes: int | None = None,
+        ttl: float | None = None,
+        sizeof: Callable[[V], int] | None = None,
+    ) -> None:
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizeof = sizeof
+        # key -> (value, size, expire at)
+        self._data: OrderedDict[K, tuple[V, int, float | None]] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return self._data.__len__()
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._data
+
+    def get(self, key: K) -> V | None:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        if item[2] is not None and item[2] <= monotonic():
+            self.pop(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key: K, value: V, ttl: float | None = None) -> None:
+        """Store `value`, for `ttl` seconds instead of the cache's `ttl` if given."""
+        size = self._sizeof(value) if self._sizeof else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.pop(key)
+            return
+
+        self.pop(key)
+        ttl = self.ttl if ttl is None else ttl
+        expire_at = monotonic() + ttl if ttl is not None else None
+        self._data[key] = (value, size, expire_at)
+        self._bytes += size
+        self._evict()
+
+    def pop(self, key: K) -> V | None:
+        item = self._data.pop(key, None)
+        if item is None:
+            return None
+
+        self._bytes -= item[1]
+        return item[0]
+
+    def items(self) -> list[tuple[K, V, float | None]]:
+        """Live entries, least recently used first, with the seconds they have left."""
+        now = monotonic()
+        return [
+            (key, value, expire_at - now if expire_at is not None else None)
+            for key, (value, _, expire_at) in self._data.items()
+            if expire_at is None or expire_at > now
+        ]
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._bytes = 0
+
+    def _evict(self) -> None:
+        while self._data and (
+            (self.max_items is not None and self._data.__len__() > self.max_items)
+            or (self.max_bytes is not None and self._bytes > self.max_bytes)
+        ):
+            _, (_, size, _) = self._data.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+            items=self._data.__len__(),
+            bytes=self._bytes,
+            max_items=self.max_items,
+            max_bytes=self.max_bytes,
+            ttl=self.ttl,
+        )
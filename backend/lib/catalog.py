@@ -0,0 +1,119 @@
+import hashlib
+import json
+import logging
+from asyncio import CancelledError, Task, create_task, sleep
+from datetime import datetime, timezone
+from time import monotonic
+
+from pydantic import BaseModel, Field
+
+from lib.env import MODEL_CATALOG_RETRY, MODEL_CATALOG_TTL
+from lib.errors import RateLimited, UpstreamUnavailable
+from lib.upstream import MODELS_TIMEOUT, Priority, request as upstream_request
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODELS = [
+    "qwen/qwen3-32b",
+    "openai/gpt-oss-120b",
+    "openai/gpt-oss-20b",
+    "meta-llama/llama-4-maverick-17b-128e-instruct",
+]
+
+
+class ModelInfo(BaseModel):
+    id: str
+    source: str  # "default" or "upstream"
+    seen_at: datetime | None = Field(default=None)
+
+
+class ModelCatalog:
+    """
+    Available models, refreshed from the upstream `/model` in the background
+    every `ttl` seconds (`retry` after a failure). Until the first refresh
+    succeeds, and whenever one fails, the last known list keeps being served.
+    The `/ai/models` body and its ETag are computed once per change.
+    """
+
+    def __init__(self, defaults: list[str], ttl: float, retry: float) -> None:
+        self.ttl = ttl
+        self.retry = retry
+        self.refreshed_at: float | None = None
+        self.models: dict[str, ModelInfo] = {}
+        self.body = b""
+        self.etag = ""
+        self._task: Task[None] | None = None
+        self._set([ModelInfo(id=model_id, source="default") for model_id in defaults])
+
+    def __contains__(self, model_id: str) -> bool:
+        return model_id in self.models
+
+    def ids(self) -> list[str]:
+        return list(self.models)
+
+    def _set(self, models: list[ModelInfo]) -> None:
+        self.models = {model.id: model for model in models}
+        self.body = json.dumps(self.ids()).encode()
+        self.etag = f'"{hashlib.sha1(self.body).hexdigest()}"'
+
+    async def refresh(self) -> bool:
+        try:
+            async with upstream_request(
+                "GET", "/model", "models", MODELS_TIMEOUT, priority=Priority.BACKGROUND
+            ) as response:
+                text = await response.text()
+
+        except (UpstreamUnavailable, RateLimited):
+            logger.warning("cannot refresh model catalog, keeping the last one")
+            return False
+
+        model_ids = [model_id.strip() for model_id in text.split(",")]
+        model_ids = [model_id for model_id in model_ids if model_id]
+        if not model_ids:
+            logger.warning("upstream returned no model, keeping the last catalog")
+            return False
+
+        now = datetime.now(timezone.utc)
+        self._set(
+            [
+                ModelInfo(id=model_id, source="upstream", seen_at=now)
+                for model_id in model_ids
+            ]
+        )
+        self.refreshed_at = monotonic()
+        return True
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            try:
+                refreshed = await self.refresh()
+
+            except CancelledError:
+                raise
+
+            except Exception:
+                logger.exception("cannot refresh model catalog")
+                refreshed = False
+
+            await sleep(self.ttl if refreshed else self.retry)
+
+    def start(self) -> None:
+        """Start refreshing in the background, without waiting for the upstream."""
+        if not self._task:
+            self._task = create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        if not self._task:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+
+        except CancelledError:
+            ...
+
+        self._task = None
+
+
+model_catalog = ModelCatalog(DEFAULT_MODELS, MODEL_CATALOG_TTL, MODEL_CATALOG_RETRY)
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import logging
+import os
+import unicodedata
+from asyncio import CancelledError, Lock, Task, create_task, shield, sleep, to_thread
+from time import time
+from typing import Iterable
+
+from pydantic import BaseModel, ValidationError
+
+from lib.cache import LRUCache
+from lib.db import MessageWithReasoning
+from lib.env import (
+    COMPLETION_CACHE_BYTES,
+    COMPLETION_CACHE_PATH,
+    COMPLETION_CACHE_SAVE_INTERVAL,
+    COMPLETION_CACHE_TTL,
+)
+
+logger = logging.getLogger(__name__)
+
+# Rough cost of the key and the bookkeeping of an entry
+ENTRY_OVERHEAD = 128
+
+
+def _completion_bytes(message: MessageWithReasoning) -> int:
+    return (
+        message.content.__len__()
+        + (message.reasoning or "").__len__()
+        + ENTRY_OVERHEAD
+    )
+
+
+# Hash of (model, messages) -> the answer the upstream gave to them. Only used
+# for titles and for prompts that ask for it, as answers are not deterministic.
+completion_cache: LRUCache[str, MessageWithReasoning] = LRUCache(
+    max_bytes=COMPLETION_CACHE_BYTES,
+    ttl=COMPLETION_CACHE_TTL or None,
+    sizeof=_completion_bytes,
+)
+
+
+def _normalize(content: str) -> str:
+    """Same text, give or take Unicode composition and whitespace."""
+    return " ".join(unicodedata.normalize("NFC", content).split())
+
+
+def completion_key(model_id: str, messages: Iterable[dict[str, str]]) -> str | None:
+    """Cache key of a completion request, `None` when the cache is disabled."""
+    if not COMPLETION_CACHE_BYTES:
+        return None
+
+    normalized = [
+        [message["role"], _normalize(message["content"])] for message in messages
+    ]
+    return hashlib.sha256(
+        json.dumps([model_id, normalized], ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+"""
+PERSISTENCE
+
+One JSON object per line, least recently used first, with the wall clock time
+an entry expires at (the cache itself counts in monotonic time). Saved every
+`COMPLETION_CACHE_SAVE_INTERVAL` and on shutdown, to a temporary file renamed
+over the last one, so a crash loses at most an interval.
+"""
+
+_save_lock = Lock()
+_save_task: Task[None] | None = None
+
+
+class CachedCompletion(BaseModel):
+    key: str
+    expires_at: float | None
+    message: MessageWithReasoning
+
+
+def _save(
+    path: str, entries: list[tuple[str, MessageWithReasoning, float | None]]
+) -> int:
+    now = time()
+    with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+        for key, message, ttl in entries:
+            entry = CachedCompletion(
+                key=key,
+                expires_at=now + ttl if ttl is not None else None,
+                message=message,
+            )
+            file.write(entry.model_dump_json() + "\n")
+    os.replace(f"{path}.tmp", path)
+    return entries.__len__()
+
+
+def _load(path: str) -> int:
+    now = time()
+    loaded = 0
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            try:
+                entry = CachedCompletion.model_validate_json(line)
+
+            except ValidationError:
+                logger.warning("skipping a malformed completion cache entry")
+                continue
+
+            if entry.expires_at is not None and entry.expires_at <= now:
+                continue
+
+            completion_cache.set(
+                entry.key,
+                entry.message,
+                ttl=entry.expires_at - now if entry.expires_at is not None else None,
+            )
+            loaded += 1
+    return loaded
+
+
+async def load() -> None:
+    if not COMPLETION_CACHE_PATH or not COMPLETION_CACHE_BYTES:
+        return
+
+    try:
+        loaded = await to_thread(_load, COMPLETION_CACHE_PATH)
+
+    except FileNotFoundError:
+        return
+
+    except OSError:
+        logger.exception("cannot read completion cache %s", COMPLETION_CACHE_PATH)
+        return
+
+    logger.info("loaded %d cached completions", loaded)
+
+
+async def save() -> None:
+    if not COMPLETION_CACHE_PATH or not COMPLETION_CACHE_BYTES:
+        return
+
+    # One write at a time, a periodic save cancelled by shutdown keeps writing
+    # in its thread. The entries are copied here, on the loop that updates them.
+    async with _save_lock:
+        try:
+            saved = await to_thread(
+                _save, COMPLETION_CACHE_PATH, completion_cache.items()
+            )
+
+        except OSError:
+            logger.exception("cannot write completion cache %s", COMPLETION_CACHE_PATH)
+            return
+
+    logger.info("saved %d cached completions", saved)
+
+
+async def _save_loop() -> None:
+    while True:
+        await sleep(COMPLETION_CACHE_SAVE_INTERVAL)
+        await shield(save())
+
+
+def start() -> None:
+    """Save the cache every `COMPLETION_CACHE_SAVE_INTERVAL` in the background."""
+    global _save_task
+    if not COMPLETION_CACHE_PATH or not COMPLETION_CACHE_BYTES:
+        return
+
+    if COMPLETION_CACHE_SAVE_INTERVAL > 0 and not _save_task:
+        _save_task = create_task(_save_loop())
+
+
+async def stop() -> None:
+    global _save_task
+    if not _save_task:
+        return
+
+    _save_task.cancel()
+    try:
+        await _save_task
+
+    except CancelledError:
+        ...
+
+    _save_task = None
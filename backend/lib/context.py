@@ -0,0 +1,149 @@
+import json
+import logging
+from math import ceil
+from typing import Callable, NamedTuple
+
+from lib.env import (
+    CONTEXT_MAX_TURNS,
+    CONTEXT_RESERVE_TOKENS,
+    CONTEXT_STRATEGY,
+    CONTEXT_TOKENS,
+    MODEL_CONTEXT_TOKENS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Rough average for English text with the usual BPE tokenizers, and the
+# per-message cost of the chat template
+CHARS_PER_TOKEN = 4
+MESSAGE_TOKEN_OVERHEAD = 4
+
+
+class ContextEntry(NamedTuple):
+    role: str
+    data: bytes  # the message as it is sent in the upstream `messages` array
+    tokens: int  # estimated
+
+
+Context = tuple[ContextEntry, ...]
+Strategy = Callable[[Context, int], Context]
+
+
+def estimate_tokens(text: str) -> int:
+    return ceil(text.__len__() / CHARS_PER_TOKEN) + MESSAGE_TOKEN_OVERHEAD
+
+
+def make_entry(role: str, content: str) -> ContextEntry:
+    return ContextEntry(
+        role=role,
+        data=json.dumps({"role": role, "content": content}).encode(),
+        tokens=estimate_tokens(content),
+    )
+
+
+def context_bytes(context: Context) -> int:
+    return sum(entry.data.__len__() for entry in context)
+
+
+def _parse_limits(raw: str) -> dict[str, int]:
+    limits: dict[str, int] = {}
+    for item in raw.split(","):
+        model_id, _, tokens = item.strip().rpartition("=")
+        if model_id and tokens:
+            limits[model_id] = int(tokens)
+    return limits
+
+
+model_context_tokens = _parse_limits(MODEL_CONTEXT_TOKENS)
+
+
+def token_budget(model_id: str) -> int:
+    """Prompt tokens allowed for the model, leaving room for the answer."""
+    limit = model_context_tokens.get(model_id, CONTEXT_TOKENS)
+    return max(limit - CONTEXT_RESERVE_TOKENS, 0)
+
+
+"""
+STRATEGIES
+
+A strategy gets the whole path (root first) and the token budget, and returns
+the entries to send. The system prompt and the newest message are always kept.
+"""
+
+
+def _split_system(context: Context) -> tuple[Context, Context]:
+    if context and context[0].role == "system":
+        return context[:1], context[1:]
+    return (), context
+
+
+def keep_all(context: Context, budget: int) -> Context:
+    return context
+
+
+def last_turns(context: Context, budget: int) -> Context:
+    """
+    System prompt and the last `CONTEXT_MAX_TURNS` user messages and answers,
+    dropping the oldest turns while they do not fit in the budget.
+    """
+    system, rest = _split_system(context)
+    starts = [index for index, entry in enumerate(rest) if entry.role == "user"]
+    if starts.__len__() > CONTEXT_MAX_TURNS:
+        starts = starts[-CONTEXT_MAX_TURNS:]
+    else:
+        # Fewer turns than allowed, keep what comes before the first one too
+        starts.insert(0, 0)
+
+    used = sum(entry.tokens for entry in system + rest[starts[0] :])
+    for previous, start in zip(starts, starts[1:]):
+        if used <= budget:
+            return system + rest[previous:]
+        used -= sum(entry.tokens for entry in rest[previous:start])
+    if used <= budget:
+        return system + rest[starts[-1] :]
+
+    # Not even the newest turn fits, send the newest message alone
+    return system + rest[-1:]
+
+
+def token_window(context: Context, budget: int) -> Context:
+    """System prompt and as many of the newest messages as fit in the budget."""
+    system, rest = _split_system(context)
+    used = sum(entry.tokens for entry in system)
+    start = rest.__len__()
+    while start > 0 and (
+        start == rest.__len__() or used + rest[start - 1].tokens <= budget
+    ):
+        start -= 1
+        used += rest[start].tokens
+    return system + rest[start:]
+
+
+STRATEGIES: dict[str, Strategy] = {
+    "all": keep_all,
+    "last_turns": last_turns,
+    "token_window": token_window,
+}
+if CONTEXT_STRATEGY not in STRATEGIES:
+    raise ValueError(f"unknown CONTEXT_STRATEGY {CONTEXT_STRATEGY!r}")
+
+
+def fit_context(context: Context, model_id: str, strategy: str | None = None) -> bytes:
+    """The `messages` array (without brackets) to send to `model_id`."""
+    name = strategy or CONTEXT_STRATEGY
+    budget = token_budget(model_id)
+    kept = STRATEGIES[name](context, budget)
+    tokens = sum(entry.tokens for entry in kept)
+
+    log = logger.info if kept.__len__() < context.__len__() else logger.debug
+    log(
+        "context for %s (%s): %d of %d messages, ~%d tokens, %d bytes, budget %d",
+        model_id,
+        name,
+        kept.__len__(),
+        context.__len__(),
+        tokens,
+        context_bytes(kept),
+        budget,
+    )
+    return b",".join(entry.data for entry in kept)
@@ -1,36 +1,68 @@
+import base64
+import hashlib
+import json
 import re
-from datetime import datetime, timezone
-from typing import Awaitable, Callable, Optional, TypeVar
+from datetime import date, datetime, timedelta, timezone
+from time import perf_counter
+from typing import AsyncGenerator, Awaitable, Callable, Optional, TypeVar
 from uuid import uuid4
 
 from argon2.exceptions import VerifyMismatchError
 from pydantic import BaseModel, Field as PydanticField
+from sqlalchemy import case, event, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import DisconnectionError
 from sqlalchemy.ext.asyncio import (
     AsyncAttrs,
     AsyncSession,
     async_sessionmaker,
     create_async_engine,
 )
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import aliased, contains_eager
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlmodel import (
     JSON,
     Column,
+    DateTime,
     Field,
     ForeignKey,
+    Index,
     Relationship,
     SQLModel,
     String,
-    and_,
     asc,
     col,
+    delete,
     desc,
+    exists,
+    func,
     select,
 )
 
-from lib.env import DB_URL
+from lib.cache import LRUCache
+from lib.env import (
+    BLOB_MIN_BYTES,
+    BLOB_STORAGE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_PRE_PING,
+    DB_POOL_RECYCLE,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_URL,
+    SQLITE_BUSY_TIMEOUT,
+    SQLITE_CACHE_SIZE,
+    SQLITE_JOURNAL_MODE,
+    SQLITE_MMAP_SIZE,
+    SQLITE_SYNCHRONOUS,
+    USER_CACHE_SIZE,
+    USER_CACHE_TTL,
+)
 from lib.errors import (
     ConversationNotFound,
     Forbidden,
+    InvalidCursor,
     InvalidPassword,
     InvalidUsername,
     MessageNotFound,
@@ -39,7 +71,9 @@ from lib.errors import (
     UserNotFound,
     WrongPassword,
 )
-from lib.hash import hash_func, verify_func
+from lib.hash import hash_async, verify_async
+from lib.metrics import observe_query
+from lib.migrations import migrate
 
 
 class User(SQLModel):
@@ -54,6 +88,7 @@ class UserWithPassword(User):
 
 class DBUser(UserWithPassword, table=True):
     __tablename__ = "user"  # type: ignore
+    __table_args__ = (Index("ix_user_username", "username"),)
 
 
 class BaseConversation(SQLModel):
@@ -64,12 +99,45 @@ class BaseConversation(SQLModel):
 
 class DBConversation(BaseConversation, table=True):
     __tablename__ = "conversation"  # type: ignore
+    __table_args__ = (
+        Index("ix_conversation_user_created_id", "user_id", "created_at", "id"),
+        Index("ix_conversation_user_updated_id", "user_id", "updated_at", "id"),
+    )
 
     user_id: str = Field(foreign_key="user.id")
-    messages: list["DBMessage"] = Relationship(back_populates="conversation")
+    # Messages are removed by the database (ON DELETE CASCADE)
+    messages: list["DBMessage"] = Relationship(
+        back_populates="conversation",
+        sa_relationship_kwargs={"passive_deletes": True},
+    )
 
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+    # Summary of the newest message, kept up to date by every write
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    message_count: int = Field(default=0)
+    head_message_id: str | None = Field(default=None)
+    preview: str = Field(default="")
+    # Bumped by every change to the conversation or its messages, for ETags
+    version: int = Field(default=0)
+
+
+class ConversationSummary(BaseConversation):
+    updated_at: datetime
+    message_count: int
+    head_message_id: str | None
+    preview: str
+
+
+PREVIEW_LENGTH = 120
+
+
+def message_preview(role: str, content: str) -> str:
+    """Start of a message on one line, the system prompt is not shown."""
+    if role == "system":
+        return ""
+    return " ".join(content.split())[:PREVIEW_LENGTH]
+
 
 class BaseMessage(SQLModel):
     role: str
@@ -84,14 +152,34 @@ class MessageWithId(MessageWithReasoning):
     id: str = Field(default_factory=lambda: uuid4().__str__(), primary_key=True)
 
 
+class DBBlob(SQLModel, table=True):
+    """
+    Message bodies stored once, keyed by their sha256. See `store_body`.
+    """
+
+    __tablename__ = "blob"  # type: ignore
+
+    hash: str = Field(primary_key=True)
+    body: str
+
+
 class DBMessage(MessageWithId, AsyncAttrs, table=True):
     __tablename__ = "message"  # type: ignore
+    __table_args__ = (
+        Index("ix_message_conversation_created", "conversation_id", "created_at"),
+        Index("ix_message_parent_created", "parent_id", "created_at", "id"),
+        Index("ix_message_content_hash", "content_hash"),
+        Index("ix_message_reasoning_hash", "reasoning_hash"),
+    )
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
-    # Content
+    # Content. When a body is in the blob table, the column is empty and the
+    # hash points to it: read it through `message_content` / `message_reasoning`
     role: str
     reasoning: Optional[str]
     content: str
+    content_hash: str | None = Field(default=None, foreign_key="blob.hash")
+    reasoning_hash: str | None = Field(default=None, foreign_key="blob.hash")
 
     # Tree relationships
     conversation_id: str = Field(
@@ -112,6 +200,208 @@ class DBMessage(MessageWithId, AsyncAttrs, table=True):
     path: list[str] = Field(sa_column=Column(JSON))
 
 
+class DBMessageAncestor(SQLModel, table=True):
+    """
+    Closure table of the message tree: one row per (ancestor, descendant) pair,
+    a message being its own ancestor at depth 0. `created_at` is the one of the
+    descendant so "latest descendant of X" is a single index range scan.
+    """
+
+    __tablename__ = "message_ancestor"  # type: ignore
+    __table_args__ = (
+        Index("ix_message_ancestor_ancestor_created", "ancestor_id", "created_at"),
+        Index("ix_message_ancestor_descendant_depth", "descendant_id", "depth"),
+    )
+
+    ancestor_id: str = Field(
+        sa_column=Column(
+            String, ForeignKey("message.id", ondelete="CASCADE"), primary_key=True
+        )
+    )
+    descendant_id: str = Field(
+        sa_column=Column(
+            String, ForeignKey("message.id", ondelete="CASCADE"), primary_key=True
+        )
+    )
+    depth: int
+    created_at: datetime = Field(sa_column=Column(DateTime, nullable=False))
+
+
+class MessageUsage(SQLModel):
+    """Token counts and timings the upstream reports for one completion."""
+
+    prompt_tokens: int = Field(default=0)
+    completion_tokens: int = Field(default=0)
+    queue_time: float = Field(default=0)
+    prompt_time: float = Field(default=0)
+    completion_time: float = Field(default=0)
+
+
+class DBMessageUsage(MessageUsage, table=True):
+    """Usage of the completion that produced an assistant message."""
+
+    __tablename__ = "message_usage"  # type: ignore
+
+    message_id: str = Field(
+        sa_column=Column(
+            String, ForeignKey("message.id", ondelete="CASCADE"), primary_key=True
+        )
+    )
+    model_id: str
+
+
+class DBUsageDaily(MessageUsage, table=True):
+    """
+    Upstream usage summed per UTC day, user, model and kind of call (`chat` or
+    `title`), kept up to date by `record_usage` on every completion.
+    """
+
+    __tablename__ = "usage_daily"  # type: ignore
+    __table_args__ = (Index("ix_usage_daily_user_day", "user_id", "day"),)
+
+    day: date = Field(primary_key=True)
+    user_id: str = Field(primary_key=True, foreign_key="user.id")
+    model_id: str = Field(primary_key=True)
+    kind: str = Field(primary_key=True)
+    requests: int = Field(default=0)
+
+
+class DBConversationListVersion(SQLModel, table=True):
+    """
+    Bumped in the transaction of every write to a conversation of the user, so
+    the ETag of their conversation lists is one primary key lookup away.
+    """
+
+    __tablename__ = "conversation_list_version"  # type: ignore
+
+    user_id: str = Field(primary_key=True, foreign_key="user.id")
+    version: int = Field(default=0)
+
+
+def _ancestor_rows(
+    message_id: str, path: list[str], created_at: datetime
+) -> list[DBMessageAncestor]:
+    return [
+        DBMessageAncestor(
+            ancestor_id=ancestor_id,
+            descendant_id=message_id,
+            depth=path.__len__() - 1 - index,
+            created_at=created_at,
+        )
+        for index, ancestor_id in enumerate(path)
+    ]
+
+
+# Bodies of a message, whether inline or in the blob table. Statements using
+# them go through `with_bodies`.
+_content_blob = aliased(DBBlob, name="content_blob")
+_reasoning_blob = aliased(DBBlob, name="reasoning_blob")
+message_content = func.coalesce(_content_blob.body, DBMessage.content)
+message_reasoning = func.coalesce(_reasoning_blob.body, DBMessage.reasoning)
+
+
+def with_bodies(statement, reasoning: bool = True):
+    statement = statement.outerjoin(
+        _content_blob, _content_blob.hash == DBMessage.content_hash
+    )
+    if reasoning:
+        statement = statement.outerjoin(
+            _reasoning_blob, _reasoning_blob.hash == DBMessage.reasoning_hash
+        )
+    return statement
+
+
+def _upsert_insert():
+    """`insert` of the dialect in use, the one with `on_conflict_*`."""
+    return postgresql_insert if engine.dialect.name == "postgresql" else sqlite_insert
+
+
+def _bump_conversation_list(user_id: str):
+    statement = _upsert_insert()(DBConversationListVersion).values(
+        user_id=user_id, version=1
+    )
+    return statement.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={"version": DBConversationListVersion.version + 1},
+    )
+
+
+def _blob_insert(body: str | None):
+    """`(hash, insert)` for a body that goes to the blob table, else None."""
+    if not BLOB_STORAGE or not body or body.encode().__len__() < BLOB_MIN_BYTES:
+        return None
+
+    hash = hashlib.sha256(body.encode()).hexdigest()
+    statement = _upsert_insert()(DBBlob).values(hash=hash, body=body)
+    if engine.dialect.name == "postgresql":
+        # A no-op update, for the row lock `_delete_orphan_blobs` waits on
+        return hash, statement.on_conflict_do_update(
+            index_elements=["hash"], set_={"hash": statement.excluded.hash}
+        )
+    return hash, statement.on_conflict_do_nothing()
+
+
+async def store_body(
+    body: str | None, session: AsyncSession
+) -> tuple[str | None, str | None]:
+    """
+    `(column value, hash)` to save a body with. Bodies of at least
+    BLOB_MIN_BYTES go to the blob table, once per distinct body.
+    """
+    blob = _blob_insert(body)
+    if not blob:
+        return body, None
+
+    hash, statement = blob
+    await session.execute(statement)
+    return "", hash
+
+
+def _restore_bodies(message: DBMessage, content: str, reasoning: str | None):
+    """Put the real bodies back on a row saved through `store_body`."""
+    set_committed_value(message, "content", content)
+    set_committed_value(message, "reasoning", reasoning)
+
+
+def _delete_orphan_blobs_statement(hashes: list[str]):
+    return delete(DBBlob).where(
+        col(DBBlob.hash).in_(hashes),
+        ~exists().where(DBMessage.content_hash == DBBlob.hash),
+        ~exists().where(DBMessage.reasoning_hash == DBBlob.hash),
+    )
+
+
+async def _delete_orphan_blobs(hashes: set[str], session: AsyncSession):
+    """
+    Delete the blobs among `hashes` that no message uses anymore.
+
+    On Postgres the blobs are locked first. A concurrent `store_body` reusing
+    one either committed before, and the delete sees its message, or waits on
+    the lock and inserts the blob again. SQLite runs one writer at a time.
+    """
+    hash_list = sorted(hashes)
+    for start in range(0, hash_list.__len__(), 500):
+        batch = hash_list[start : start + 500]
+        if engine.dialect.name == "postgresql":
+            await session.execute(
+                select(DBBlob.hash)
+                .where(col(DBBlob.hash).in_(batch))
+                .order_by(DBBlob.hash)
+                .with_for_update()
+            )
+        await session.execute(_delete_orphan_blobs_statement(batch))
+
+
+async def _blob_hashes(statement, session: AsyncSession) -> set[str]:
+    """Hashes used by the messages `statement` (a select of message ids) picks."""
+    result = await session.execute(
+        select(DBMessage.content_hash, DBMessage.reasoning_hash).where(
+            col(DBMessage.id).in_(statement)
+        )
+    )
+    return {hash for row in result.all() for hash in row if hash}
+
+
 class BranchInfo(BaseModel):
     total: int
     current: int
@@ -121,8 +411,23 @@ class MessageWithBranch(MessageWithId):
     branch: Optional[BranchInfo]
 
 
+class BranchCounter(BaseModel):
+    id: str
+    branch: BranchInfo
+
+
+class BranchDelta(BaseModel):
+    messages: list[MessageWithBranch]
+    branches: list[BranchCounter]
+
+
 class GetConversationResponse(BaseConversation):
     messages: list[MessageWithBranch]
+    title_pending: bool = Field(default=False)
+    # With `since`: `messages` only has the messages after it, and `branches`
+    # the counters of the ones before
+    partial: bool = Field(default=False)
+    branches: list[BranchCounter] = Field(default_factory=list)
 
 class UpdateUser(BaseModel):
     username: Optional[str] = PydanticField(default=None)
@@ -130,12 +435,111 @@ class UpdateUser(BaseModel):
     model_personality: Optional[str] = PydanticField(default=None)
 
 
-engine = create_async_engine(DB_URL)
+class PoolStats(BaseModel):
+    size: int
+    checked_out: int
+    overflow: int
+    checkouts: int
+    wait_seconds_total: float
+    wait_seconds_max: float
+
+
+class TimedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool recording how long a checkout waits for a connection."""
+
+    checkouts = 0
+    wait_seconds_total = 0.0
+    wait_seconds_max = 0.0
+
+    def _do_get(self):
+        started_at = perf_counter()
+        try:
+            return super()._do_get()
+
+        finally:
+            wait = perf_counter() - started_at
+            TimedQueuePool.checkouts += 1
+            TimedQueuePool.wait_seconds_total += wait
+            TimedQueuePool.wait_seconds_max = max(
+                TimedQueuePool.wait_seconds_max, wait
+            )
+
+
+engine = create_async_engine(
+    DB_URL,
+    poolclass=TimedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING,
+)
+session_factory = async_sessionmaker(engine, expire_on_commit=False)
+
+
+@event.listens_for(engine.sync_engine, "connect")
+def _tune_sqlite(dbapi_connection, connection_record):
+    if engine.dialect.name != "sqlite":
+        return
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+@event.listens_for(engine.sync_engine, "checkout")
+def _discard_closed_sqlite(dbapi_connection, connection_record, connection_proxy):
+    """
+    A SQLite connection whose close was cancelled (the client left mid-query)
+    can be handed out again closed. Pre-ping is off for SQLite, so check it
+    without a round trip: reading the public `isolation_level` of a closed
+    aiosqlite connection raises `ValueError("no active connection")`, as of the
+    pinned aiosqlite 0.21 (the message SQLAlchemy's `is_disconnect` matches).
+    The pool replaces the connection on `DisconnectionError`.
+    """
+    if engine.dialect.name != "sqlite" or DB_POOL_PRE_PING:
+        return
+
+    try:
+        dbapi_connection.isolation_level
+
+    except ValueError as error:
+        raise DisconnectionError("closed SQLite connection") from error
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_started_at = perf_counter()
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _query_done(conn, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, "_metrics_started_at", None)
+    if started_at is not None:
+        observe_query(perf_counter() - started_at)
+
+
+def pool_stats() -> PoolStats:
+    pool = engine.pool
+    return PoolStats(
+        size=pool.size(),  # type: ignore
+        checked_out=pool.checkedout(),  # type: ignore
+        overflow=pool.overflow(),  # type: ignore
+        checkouts=TimedQueuePool.checkouts,
+        wait_seconds_total=TimedQueuePool.wait_seconds_total,
+        wait_seconds_max=TimedQueuePool.wait_seconds_max,
+    )
 
 
 async def init():
     async with engine.begin() as conn:
-        await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(migrate)
 
 
 T = TypeVar("T")
@@ -148,14 +552,12 @@ async def create_session_and_run(
     if session:
         return await func(session)
     else:
-        async_session = async_sessionmaker(engine, expire_on_commit=False)
-        async with async_session() as session:
+        async with session_factory() as session:
             return await func(session)
 
 
 async def get_session():
-    async_session = async_sessionmaker(engine, expire_on_commit=False)
-    async with async_session() as session:
+    async with session_factory() as session:
         yield session
 
 
@@ -178,16 +580,144 @@ If the user does not specify a personality, default to warm, professional, and s
 """
 
 
+class ConversationPage(BaseModel):
+    conversations: list[DBConversation]
+    next_cursor: str | None
+
+
+class ConversationSummaryPage(BaseModel):
+    conversations: list[ConversationSummary]
+    next_cursor: str | None
+
+
+def _encode_cursor(at: datetime, id: str) -> str:
+    raw = json.dumps([at.isoformat(), id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, str]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not (
+            isinstance(payload, list)
+            and payload.__len__() == 2
+            and all(isinstance(item, str) for item in payload)
+        ):
+            raise InvalidCursor()
+
+        created_at, id = payload
+        return datetime.fromisoformat(created_at), id
+
+    except (ValueError, TypeError):
+        raise InvalidCursor()
+
+
+def _conversations_statement(
+    user_id: str,
+    after: tuple[datetime, str] | None = None,
+    title_prefix: str | None = None,
+    limit: int | None = None,
+):
+    statement = (
+        select(DBConversation)
+        .where(DBConversation.user_id == user_id)
+        .order_by(desc(DBConversation.created_at), desc(DBConversation.id))
+    )
+    if after:
+        statement = statement.where(
+            tuple_(DBConversation.created_at, DBConversation.id) < tuple_(*after)
+        )
+    if title_prefix:
+        statement = statement.where(
+            col(DBConversation.title).startswith(title_prefix, autoescape=True)
+        )
+    if limit:
+        statement = statement.limit(limit + 1)
+    return statement
+
+
 async def get_conversations(
-    user: User, session: AsyncSession | None = None
-) -> list[DBConversation]:
+    user: User,
+    limit: int | None = None,
+    cursor: str | None = None,
+    title_prefix: str | None = None,
+    session: AsyncSession | None = None,
+) -> ConversationPage:
+    """
+    Newest first. Pages are keyset based on (created_at, id): `cursor` is the
+    `next_cursor` of the previous page, so every page is one index range scan.
+    """
+
     async def _iner(session: AsyncSession):
-        statement = (
-            select(DBConversation)
-            .where(DBConversation.user_id == user.id)
-            .order_by(desc(DBConversation.created_at))
+        statement = _conversations_statement(
+            user.id, _decode_cursor(cursor) if cursor else None, title_prefix, limit
+        )
+        conversations = list((await session.execute(statement)).scalars().all())
+        if not limit or conversations.__len__() <= limit:
+            return ConversationPage(conversations=conversations, next_cursor=None)
+
+        conversations = conversations[:limit]
+        last = conversations[-1]
+        return ConversationPage(
+            conversations=conversations,
+            next_cursor=_encode_cursor(last.created_at, last.id),
+        )
+
+    return await create_session_and_run(_iner, session)
+
+
+def _summaries_statement(
+    user_id: str,
+    after: tuple[datetime, str] | None = None,
+    limit: int | None = None,
+):
+    statement = (
+        select(
+            DBConversation.id,
+            DBConversation.model_id,
+            DBConversation.title,
+            DBConversation.updated_at,
+            DBConversation.message_count,
+            DBConversation.head_message_id,
+            DBConversation.preview,
+        )
+        .where(DBConversation.user_id == user_id)
+        .order_by(desc(DBConversation.updated_at), desc(DBConversation.id))
+    )
+    if after:
+        statement = statement.where(
+            tuple_(DBConversation.updated_at, DBConversation.id) < tuple_(*after)
+        )
+    if limit:
+        statement = statement.limit(limit + 1)
+    return statement
+
+
+async def get_conversation_summaries(
+    user: User,
+    limit: int | None = None,
+    cursor: str | None = None,
+    session: AsyncSession | None = None,
+) -> ConversationSummaryPage:
+    """
+    Recently active first, reading only the summary columns. Same keyset
+    paging as `get_conversations`, on (updated_at, id).
+    """
+
+    async def _iner(session: AsyncSession):
+        statement = _summaries_statement(
+            user.id, _decode_cursor(cursor) if cursor else None, limit
+        )
+        rows = (await session.execute(statement)).all()
+        summaries = [ConversationSummary(**row._asdict()) for row in rows]
+        if not limit or summaries.__len__() <= limit:
+            return ConversationSummaryPage(conversations=summaries, next_cursor=None)
+
+        summaries = summaries[:limit]
+        return ConversationSummaryPage(
+            conversations=summaries,
+            next_cursor=_encode_cursor(summaries[-1].updated_at, summaries[-1].id),
         )
-        return list((await session.execute(statement)).scalars().all())
 
     return await create_session_and_run(_iner, session)
 
@@ -207,44 +737,99 @@ async def get_conversation(
     return await create_session_and_run(_iner, session)
 
 
+def _stamp_statement(user_id: str):
+    return select(DBConversationListVersion.version).where(
+        DBConversationListVersion.user_id == user_id
+    )
+
+
+async def get_conversations_stamp(
+    user: User, session: AsyncSession | None = None
+) -> int:
+    """
+    Changes whenever a conversation of the user is created, deleted or
+    changed, see `DBConversationListVersion`.
+    """
+
+    async def _iner(session: AsyncSession):
+        return (await session.execute(_stamp_statement(user.id))).scalar() or 0
+
+    return await create_session_and_run(_iner, session)
+
+
 async def update_conversation_title(
     id: str, title: str, session: AsyncSession | None = None
 ):
     async def _iner(session: AsyncSession):
-        statement = select(DBConversation).where(DBConversation.id == id).limit(1)
-        result = await session.execute(statement)
-        conservation = result.scalar()
-        if not conservation:
+        statement = (
+            update(DBConversation)
+            .where(col(DBConversation.id) == id)
+            .values(title=title, version=DBConversation.version + 1)
+            .returning(DBConversation.user_id)
+        )
+        user_id = (await session.execute(statement)).scalar()
+        if user_id is None:
             raise ConversationNotFound()
 
-        conservation.title = title
-        session.add(conservation)
+        await session.execute(_bump_conversation_list(user_id))
         await session.commit()
 
-        return conservation
-
     return await create_session_and_run(_iner, session)
 
 
-async def get_message(id: str, session: AsyncSession | None = None) -> DBMessage:
+def _children_statement(id: str):
+    return with_bodies(
+        select(
+            DBMessage.id,
+            DBMessage.role,
+            message_content.label("content"),
+            message_reasoning.label("reasoning"),
+        )
+        .where(DBMessage.parent_id == id)
+        .order_by(asc(DBMessage.created_at), asc(DBMessage.id))
+    )
+
+
+async def get_children(
+    id: str, session: AsyncSession | None = None
+) -> list[MessageWithId]:
     async def _iner(session: AsyncSession):
-        statement = (
+        rows = (await session.execute(_children_statement(id))).mappings().all()
+        return [MessageWithId(**row) for row in rows]
+
+    return await create_session_and_run(_iner, session)
+
+
+def _latest_message_statement(
+    conversation_id: str, contain_message: str | None = None
+):
+    """Newest message of the conversation, or of those under `contain_message`."""
+    if contain_message:
+        return (
             select(DBMessage)
-            .where(DBMessage.id == id)
-            .limit(1)
-            .options(
-                selectinload(DBMessage.conversation),  # type: ignore
-                selectinload(DBMessage.children),  # type: ignore
+            .join(
+                DBMessageAncestor,
+                col(DBMessageAncestor.descendant_id) == DBMessage.id,
             )
+            .where(
+                DBMessageAncestor.ancestor_id == contain_message,
+                DBMessage.conversation_id == conversation_id,
+            )
+            .order_by(desc(DBMessageAncestor.created_at))
+            .limit(1)
         )
-        result = await session.execute(statement)
-        message = result.scalar()
-        if not message:
-            raise MessageNotFound()
+    return (
+        select(DBMessage)
+        .where(DBMessage.conversation_id == conversation_id)
+        .order_by(desc(DBMessage.created_at))
+        .limit(1)
+    )
 
-        await session.refresh(message, ["conversation", "children"])
 
-        return message
+async def has_children(id: str, session: AsyncSession | None = None) -> bool:
+    async def _iner(session: AsyncSession):
+        statement = select(exists().where(DBMessage.parent_id == id))
+        return bool((await session.execute(statement)).scalar())
 
     return await create_session_and_run(_iner, session)
 
@@ -256,21 +841,12 @@ async def get_latest_message_of_conversation(
 ) -> DBMessage:
     async def _iner(session: AsyncSession):
         conversation = await get_conversation(conversation_id, session)
-        if contain_message:
-            await get_message(contain_message)
-        statement = (
-            select(DBMessage)
-            .where(
-                and_(
-                    DBMessage.conversation_id == conversation.id,
-                    col(DBMessage.path).contains(contain_message)
-                    if contain_message
-                    else True,
-                )
+        if not contain_message and conversation.head_message_id:
+            statement = select(DBMessage).where(
+                DBMessage.id == conversation.head_message_id
             )
-            .order_by(desc(DBMessage.created_at))
-            .limit(1)
-        )
+        else:
+            statement = _latest_message_statement(conversation.id, contain_message)
         result = await session.execute(statement)
         message = result.scalar()
         if not message:
@@ -295,21 +871,36 @@ async def create_new_conversation(
         user = await get_user_db(user_id, session=session)
 
         conversation_id = uuid4().__str__()
-        conversation = DBConversation(
-            id=conversation_id, user_id=user.id, model_id=model_id
-        )
-
         system_message_id = uuid4().__str__()
+        system_prompt = get_system_prompt(user.model_personality)
+        content, content_hash = await store_body(system_prompt, session)
         system_message = DBMessage(
             id=system_message_id,
-            content=get_system_prompt(user.model_personality),
+            content=content,
+            content_hash=content_hash,
             reasoning=None,
             role="system",
-            conversation_id=conversation.id,
+            conversation_id=conversation_id,
             path=[system_message_id],
         )
+        conversation = DBConversation(
+            id=conversation_id,
+            user_id=user.id,
+            model_id=model_id,
+            created_at=system_message.created_at,
+            updated_at=system_message.created_at,
+            message_count=1,
+            head_message_id=system_message_id,
+        )
 
         session.add_all([conversation, system_message])
+        await session.flush()
+        session.add_all(
+            _ancestor_rows(
+                system_message_id, system_message.path, system_message.created_at
+            )
+        )
+        await session.execute(_bump_conversation_list(user.id))
         await session.commit()
 
         return (
@@ -317,7 +908,7 @@ async def create_new_conversation(
             MessageWithId(
                 role="system",
                 reasoning=None,
-                content=system_message.content,
+                content=system_prompt,
                 id=system_message_id,
             ),
         )
@@ -325,141 +916,416 @@ async def create_new_conversation(
     return await create_session_and_run(_iner, session)
 
 
+def _context_statement(message_id: str):
+    return with_bodies(
+        select(
+            DBMessage.id,
+            DBMessage.role,
+            message_content.label("content"),
+            message_reasoning.label("reasoning"),
+        )
+        .join(
+            DBMessageAncestor,
+            col(DBMessageAncestor.ancestor_id) == DBMessage.id,
+        )
+        .where(DBMessageAncestor.descendant_id == message_id)
+        .order_by(desc(DBMessageAncestor.depth))
+    )
+
+
 async def get_conversation_context(
     message_id: str, session: AsyncSession | None = None
 ) -> list[MessageWithId]:
     async def _iner(session: AsyncSession):
-        base_statement = select(DBMessage).where(DBMessage.id == message_id)
-        base_result = await session.execute(base_statement)
-        base_message = base_result.scalar()
-        if not base_message:
+        statement = _context_statement(message_id)
+        rows = (await session.execute(statement)).mappings().all()
+        if not rows:
             raise MessageNotFound()
 
-        statement = (
-            select(DBMessage)
-            .where(col(DBMessage.id).in_(base_message.path))
-            .order_by(asc(DBMessage.created_at))
-        )
-        result = await session.execute(statement)
-        messages = result.scalars().all()
-        return [MessageWithId(**(message.model_dump())) for message in messages]
+        return [MessageWithId(**row) for row in rows]
 
     return await create_session_and_run(_iner, session)
 
 
 async def follow_up(
-    follow_message: str,
+    follow_message: "str | DBMessage",
     new_message: MessageWithReasoning,
     session: AsyncSession | None = None,
+    usage: MessageUsage | None = None,
 ) -> DBMessage:
+    """
+    `follow_message` is an id, or the row itself if it was already loaded.
+    `usage` is the one of the completion that produced `new_message`.
+    """
+
     async def _iner(session: AsyncSession):
-        statement = select(DBMessage).where(DBMessage.id == follow_message)
-        result = await session.execute(statement)
-        follow_db_message = result.scalar()
-        if not follow_db_message:
-            raise MessageNotFound()
+        if isinstance(follow_message, DBMessage):
+            follow_db_message = follow_message
+        else:
+            statement = select(DBMessage).where(DBMessage.id == follow_message)
+            result = await session.execute(statement)
+            follow_db_message = result.scalar()
+            if not follow_db_message:
+                raise MessageNotFound()
 
         new_db_message_id = uuid4().__str__()
+        content, content_hash = await store_body(new_message.content, session)
+        reasoning, reasoning_hash = await store_body(new_message.reasoning, session)
         new_db_message = DBMessage(
             id=new_db_message_id,
-            content=new_message.content,
-            reasoning=new_message.reasoning,
+            content=content,
+            content_hash=content_hash,
+            reasoning=reasoning,
+            reasoning_hash=reasoning_hash,
             role=new_message.role,
             conversation_id=follow_db_message.conversation_id,
             parent_id=follow_db_message.id,
             path=[*follow_db_message.path, new_db_message_id],
         )
         session.add(new_db_message)
+        await session.flush()
+        session.add_all(
+            _ancestor_rows(
+                new_db_message_id, new_db_message.path, new_db_message.created_at
+            )
+        )
+        result = await session.execute(
+            update(DBConversation)
+            .where(col(DBConversation.id) == new_db_message.conversation_id)
+            .values(
+                updated_at=new_db_message.created_at,
+                message_count=DBConversation.message_count + 1,
+                head_message_id=new_db_message_id,
+                preview=message_preview(new_message.role, new_message.content),
+                version=DBConversation.version + 1,
+            )
+            .returning(DBConversation.user_id, DBConversation.model_id)
+        )
+        user_id, model_id = result.one()
+        await session.execute(_bump_conversation_list(user_id))
+        if usage:
+            session.add(
+                DBMessageUsage(
+                    message_id=new_db_message_id,
+                    model_id=model_id,
+                    **usage.model_dump(),
+                )
+            )
+            await session.execute(_usage_upsert(user_id, model_id, "chat", usage))
         await session.commit()
         await session.refresh(new_db_message, ["conversation"])
+        _restore_bodies(new_db_message, new_message.content, new_message.reasoning)
 
         return new_db_message
 
     return await create_session_and_run(_iner, session)
 
 
-async def get_branch_info(last_message_id: str, session: AsyncSession | None = None):
+def _branch_statement(last_message_id: str):
+    """
+    Path to `last_message_id`, root first, as `(id, total, current)` rows and
+    the `path` CTE (`ancestor_id`, `depth` from the last message). `total` and
+    `current` are the number of children of the message and the 1 based
+    position (oldest first) of the one on the path. Siblings are only read as
+    ids.
+    """
+    path = (
+        select(DBMessageAncestor.ancestor_id, DBMessageAncestor.depth)
+        .where(DBMessageAncestor.descendant_id == last_message_id)
+        .cte("path")
+    )
+    child = path.alias("child")
+    siblings = (
+        select(
+            DBMessage.id,
+            func.count().over(partition_by=DBMessage.parent_id).label("total"),
+            func.row_number()
+            .over(
+                partition_by=DBMessage.parent_id,
+                order_by=(DBMessage.created_at, DBMessage.id),
+            )
+            .label("current"),
+        )
+        .where(col(DBMessage.parent_id).in_(select(path.c.ancestor_id)))
+        .cte("siblings")
+    )
+    statement = (
+        select(DBMessage.id, siblings.c.total, siblings.c.current)
+        .join(path, path.c.ancestor_id == DBMessage.id)
+        .outerjoin(child, child.c.depth == path.c.depth - 1)
+        .outerjoin(siblings, siblings.c.id == child.c.ancestor_id)
+        .order_by(desc(path.c.depth))
+    )
+    return statement, path
+
+
+def _branch(total: int | None, current: int | None) -> BranchInfo | None:
+    if not total or total < 2 or not current:
+        return None
+    return BranchInfo(total=total, current=current)
+
+
+def _branch_info_statement(last_message_id: str):
+    statement, _ = _branch_statement(last_message_id)
+    return with_bodies(
+        statement.add_columns(DBMessage.role, message_content, message_reasoning)
+    )
+
+
+async def get_branch_info(
+    last_message_id: str, session: AsyncSession | None = None
+) -> list[MessageWithBranch]:
+    """
+    Messages on the path to `last_message_id`, root first. A message with more
+    than one child gets `branch`. One statement.
+    """
+
     async def _iner(session: AsyncSession):
-        last_message = await get_message(last_message_id, session)
+        statement = _branch_info_statement(last_message_id)
+        rows = (await session.execute(statement)).all()
+        if not rows:
+            raise MessageNotFound()
 
-        current_path = last_message.path
-        if len(current_path) < 2:
-            messages = await get_conversation_context(last_message.id, session)
-            return [
-                MessageWithBranch(**message.model_dump(), branch=None)
-                for message in messages
-            ]
+        return [
+            MessageWithBranch(
+                id=id,
+                role=role,
+                content=content,
+                reasoning=reasoning,
+                branch=_branch(total, current),
+            )
+            for id, total, current, role, content, reasoning in rows
+        ]
 
-        statement = (
-            select(DBMessage)
-            .where(col(DBMessage.id).in_(current_path))
-            .order_by(asc(DBMessage.created_at))
-        )
-        result = await session.execute(statement)
-        messages_in_branch = result.scalars().all()
+    return await create_session_and_run(_iner, session)
 
-        parent_ids = current_path[:-1]
-        statement = (
-            select(DBMessage)
-            .where(col(DBMessage.parent_id).in_(parent_ids))
-            .order_by(asc(DBMessage.created_at))
+
+def _branch_delta_statement(last_message_id: str, since: str):
+    statement, path = _branch_statement(last_message_id)
+    since_depth = (
+        select(path.c.depth).where(path.c.ancestor_id == since).scalar_subquery()
+    )
+    new = path.c.depth < since_depth
+    return with_bodies(
+        statement.add_columns(
+            DBMessage.role,
+            case((new, message_content)),
+            case((new, message_reasoning)),
+            new,
         )
-        children_result = await session.execute(statement)
-        children = children_result.scalars().all()
+    )
 
-        children_map: dict[str, list[str]] = {}
-        for child in children:
-            if not child.parent_id:
-                continue
-            if child.parent_id not in children_map:
-                children_map[child.parent_id] = []
-            children_map[child.parent_id].append(child.id)
-
-        message_with_branch: list[MessageWithBranch] = []
-        for message in messages_in_branch:
-            if message.id not in children_map or children_map[message.id].__len__() < 2:
-                message_with_branch.append(
-                    MessageWithBranch(**message.model_dump(), branch=None)
-                )
-                continue
 
-            try:
-                ind, _ = next(
-                    (index, child)
-                    for index, child in enumerate(children_map[message.id])
-                    if child in current_path
-                )
-                message_with_branch.append(
+async def get_branch_delta(
+    last_message_id: str, since: str, session: AsyncSession | None = None
+) -> BranchDelta | None:
+    """
+    Messages on the path to `last_message_id` that come after `since`, and the
+    branch counters of `since` and the messages before it. Content is only
+    read for the new messages. None if `since` is not on the path.
+    """
+
+    async def _iner(session: AsyncSession):
+        statement = _branch_delta_statement(last_message_id, since)
+        rows = (await session.execute(statement)).all()
+        if not any(row[0] == since for row in rows):
+            return None
+
+        delta = BranchDelta(messages=[], branches=[])
+        for id, total, current, role, content, reasoning, is_new in rows:
+            branch = _branch(total, current)
+            if is_new:
+                delta.messages.append(
                     MessageWithBranch(
-                        **message.model_dump(),
-                        branch=BranchInfo(
-                            total=children_map[message.id].__len__(), current=ind + 1
-                        ),
+                        id=id,
+                        role=role,
+                        content=content,
+                        reasoning=reasoning,
+                        branch=branch,
                     )
                 )
+            elif branch:
+                delta.branches.append(BranchCounter(id=id, branch=branch))
 
-            except StopIteration:
-                message_with_branch.append(
-                    MessageWithBranch(**message.model_dump(), branch=None)
-                )
-
-        return message_with_branch
+        return delta
 
     return await create_session_and_run(_iner, session)
 
 
+class ExportedMessage(BaseModel):
+    id: str
+    parent_id: str | None
+    role: str
+    content: str
+    reasoning: str | None = PydanticField(default=None)
+    created_at: datetime
+
+
+async def export_conversation(
+    conversation_id: str, reasoning: bool = False, batch_size: int = 500
+) -> AsyncGenerator[ExportedMessage, None]:
+    """
+    Every message of the conversation, oldest first (so a parent always comes
+    before its children), read through a server side cursor `batch_size` rows
+    at a time. Opens its own session, so it can outlive the request's one.
+    """
+    columns = [
+        DBMessage.id,
+        DBMessage.parent_id,
+        DBMessage.role,
+        message_content.label("content"),
+        DBMessage.created_at,
+    ]
+    if reasoning:
+        columns.append(message_reasoning.label("reasoning"))
+    statement = with_bodies(
+        select(*columns)
+        .where(DBMessage.conversation_id == conversation_id)
+        .order_by(asc(DBMessage.created_at))
+        .execution_options(yield_per=batch_size),
+        reasoning,
+    )
+
+    async with session_factory() as session:
+        result = await session.stream(statement)
+        async for row in result.mappings():
+            yield ExportedMessage(**row)
+
+
 async def delete_conversation(
     id: str,
     session: AsyncSession | None = None,
 ):
     async def _iner(session: AsyncSession):
         exist_conversation = await get_conversation(id=id, session=session)
+        hashes = await _blob_hashes(
+            select(DBMessage.id).where(DBMessage.conversation_id == id), session
+        )
+        user_id = exist_conversation.user_id
         await session.delete(exist_conversation)
+        await session.flush()
+        await _delete_orphan_blobs(hashes, session)
+        await session.execute(_bump_conversation_list(user_id))
+        await session.commit()
+
+    return await create_session_and_run(_iner, session)
+
+
+"""
+USAGE
+"""
+
+USAGE_COUNTERS = (
+    "requests",
+    "prompt_tokens",
+    "completion_tokens",
+    "queue_time",
+    "prompt_time",
+    "completion_time",
+)
+USAGE_GROUPS = {
+    "day": DBUsageDaily.day,
+    "user": DBUsageDaily.user_id,
+    "model": DBUsageDaily.model_id,
+    "kind": DBUsageDaily.kind,
+}
+
+
+def _usage_upsert(user_id, model_id: str, kind: str, usage: MessageUsage):
+    """Add one completion to today's rollup row, `user_id` may be a subquery."""
+    statement = _upsert_insert()(DBUsageDaily).values(
+        day=datetime.now(timezone.utc).date(),
+        user_id=user_id,
+        model_id=model_id,
+        kind=kind,
+        requests=1,
+        **usage.model_dump(),
+    )
+    table = DBUsageDaily.__table__.c  # type: ignore
+    return statement.on_conflict_do_update(
+        index_elements=["day", "user_id", "model_id", "kind"],
+        set_={name: table[name] + statement.excluded[name] for name in USAGE_COUNTERS},
+    )
+
+
+async def record_usage(
+    conversation_id: str,
+    model_id: str,
+    kind: str,
+    usage: MessageUsage,
+    session: AsyncSession | None = None,
+):
+    """Count a completion not tied to a message (a title) for the conversation owner."""
+
+    async def _iner(session: AsyncSession):
+        user_id = (
+            select(DBConversation.user_id)
+            .where(col(DBConversation.id) == conversation_id)
+            .scalar_subquery()
+        )
+        await session.execute(_usage_upsert(user_id, model_id, kind, usage))
         await session.commit()
 
     return await create_session_and_run(_iner, session)
 
 
+class UsageAggregate(SQLModel):
+    day: date | None = Field(default=None)
+    user_id: str | None = Field(default=None)
+    model_id: str | None = Field(default=None)
+    kind: str | None = Field(default=None)
+    requests: int
+    prompt_tokens: int
+    completion_tokens: int
+    queue_time: float
+    prompt_time: float
+    completion_time: float
+
+
+def _usage_statement(
+    group_by: list[str], since: date, until: date, user_id: str | None = None
+):
+    groups = [USAGE_GROUPS[name] for name in dict.fromkeys(group_by)]
+    table = DBUsageDaily.__table__.c  # type: ignore
+    statement = (
+        select(
+            *groups,
+            *(
+                func.coalesce(func.sum(table[name]), 0).label(name)
+                for name in USAGE_COUNTERS
+            ),
+        )
+        .where(col(DBUsageDaily.day) >= since, col(DBUsageDaily.day) <= until)
+        .group_by(*groups)
+        .order_by(*groups)
+    )
+    if user_id is not None:
+        statement = statement.where(DBUsageDaily.user_id == user_id)
+    return statement
+
+
+async def get_usage(
+    group_by: list[str],
+    since: date | None = None,
+    until: date | None = None,
+    user_id: str | None = None,
+    session: AsyncSession | None = None,
+) -> list[UsageAggregate]:
+    """
+    Sums of the daily rollups between `since` and `until` (included, the last
+    30 days by default), grouped by any of `USAGE_GROUPS`. Never reads messages.
+    """
+    until = until or datetime.now(timezone.utc).date()
+    since = since or until - timedelta(days=29)
+
+    async def _iner(session: AsyncSession):
+        statement = _usage_statement(group_by, since, until, user_id)
+        result = await session.execute(statement)
+        return [UsageAggregate(**row) for row in result.mappings()]
+
+    return await create_session_and_run(_iner, session)
+
+
 """
 USER
 """
@@ -486,6 +1352,10 @@ async def get_users(session: AsyncSession | None = None) -> list[User]:
     return await create_session_and_run(_iner, session)
 
 
+def _user_by_username_statement(username: str):
+    return select(DBUser).where(DBUser.username == username)
+
+
 async def get_user_db(
     id: str | None = None,
     username: str | None = None,
@@ -505,7 +1375,7 @@ async def get_user_db(
                 return user
 
         if username:
-            result = await session.execute(statement.where(DBUser.username == username))
+            result = await session.execute(_user_by_username_statement(username))
             user = result.scalar()
 
         return user
@@ -517,9 +1387,24 @@ async def get_user_db(
     return user
 
 
+# Users by id for `get_user`, the lookup behind every authenticated request.
+# `update_user` and `delete_user` invalidate their entry, the TTL bounds how
+# stale another process's copy can be.
+user_cache: LRUCache[str, User] = LRUCache(
+    max_items=USER_CACHE_SIZE, ttl=USER_CACHE_TTL
+)
+
+
 async def get_user(id: str | None = None, username: str | None = None) -> User:
+    if id:
+        cached_user = user_cache.get(id)
+        if cached_user is not None:
+            return cached_user
+
     user: DBUser = await get_user_db(id=id, username=username)
-    return User(**user.model_dump())
+    cached_user = User(**user.model_dump())
+    user_cache.set(user.id, cached_user)
+    return cached_user
 
 
 async def verify_user(
@@ -530,7 +1415,7 @@ async def verify_user(
     user = user or await get_user_db(id=id)
 
     try:
-        return verify_func(user.password, input_password)
+        return await verify_async(user.password, input_password)
 
     except (AssertionError, VerifyMismatchError):
         raise WrongPassword()
@@ -548,7 +1433,7 @@ async def _new_user(new_user: DBUser, session: AsyncSession | None = None):
         except UserNotFound:
             ...
 
-        new_user.password = hash_func(new_user.password)
+        new_user.password = await hash_async(new_user.password)
 
         session.add(new_user)
         await session.commit()
@@ -604,7 +1489,7 @@ async def update_user(
                     if not _check_password_safety(value):
                         raise InvalidPassword()
 
-                    value = hash_func(value)
+                    value = await hash_async(value)
 
                 if value:
                     setattr(db_user, key, value)
@@ -617,6 +1502,7 @@ async def update_user(
 
         session.add(db_user)
         await session.commit()
+        user_cache.pop(db_user.id)
 
         return await get_user_db(username=db_user.username, session=session)
 
@@ -631,8 +1517,29 @@ async def delete_user(
 ):
     async def _iner(session: AsyncSession):
         exist_user = await get_user_db(id=id, username=username, session=session)
+        hashes = await _blob_hashes(
+            select(DBMessage.id)
+            .join(DBConversation, col(DBConversation.id) == DBMessage.conversation_id)
+            .where(DBConversation.user_id == exist_user.id),
+            session,
+        )
+        await session.execute(
+            delete(DBConversation).where(
+                col(DBConversation.user_id) == exist_user.id
+            )
+        )
+        await _delete_orphan_blobs(hashes, session)
+        await session.execute(
+            delete(DBUsageDaily).where(col(DBUsageDaily.user_id) == exist_user.id)
+        )
+        await session.execute(
+            delete(DBConversationListVersion).where(
+                col(DBConversationListVersion.user_id) == exist_user.id
+            )
+        )
         await session.delete(exist_user)
         await session.commit()
+        user_cache.pop(exist_user.id)
 
     return await create_session_and_run(_iner, session)
 
@@ -640,31 +1547,42 @@ async def delete_user(
 # UTILS
 async def user_can_see_message(
     user_id: str, message_id: str, session: AsyncSession | None = None
-):
-    async def _iner(session: AsyncSession):
-        user = await get_user_db(id=user_id, session=session)
-        message = await get_message(message_id, session)
+) -> DBMessage:
+    """
+    Check in one query that the message belongs to one of the user's
+    conversations and return it, with `conversation` loaded, so the caller
+    does not fetch them again.
+    """
 
-        await session.refresh(message, ["conversation"])
+    async def _iner(session: AsyncSession):
+        statement = (
+            select(DBMessage)
+            .join(DBMessage.conversation)  # type: ignore
+            .options(contains_eager(DBMessage.conversation))  # type: ignore
+            .where(DBMessage.id == message_id)
+            .limit(1)
+        )
+        message = (await session.execute(statement)).scalar()
+        if not message:
+            raise MessageNotFound()
 
-        if message.conversation.user_id != user.id:
+        if message.conversation.user_id != user_id:
             raise Forbidden()
 
-        return "ok"
+        return message
 
     return await create_session_and_run(_iner, session)
 
 
 async def user_can_see_conversation(
     user_id: str, conversation_id: str, session: AsyncSession | None = None
-):
+) -> DBConversation:
     async def _iner(session: AsyncSession):
-        user = await get_user_db(id=user_id, session=session)
         conversation = await get_conversation(conversation_id, session)
 
-        if conversation.user_id != user.id:
+        if conversation.user_id != user_id:
             raise Forbidden()
 
-        return "ok"
+        return conversation
 
     return await create_session_and_run(_iner, session)
@@ -6,4 +6,81 @@ DB_URL = os.getenv("DB_URL", "sqlite+aiosqlite:///data/database.db")
 SIGNATURE = os.getenv(
     "SIGNATURE", hashlib.sha256(uuid4().__str__().encode()).hexdigest()
 )
-USE_HASH = os.getenv("USE_HASH", "true").lower() == "true"
\ No newline at end of file
+USE_HASH = os.getenv("USE_HASH", "true").lower() == "true"
+CONTEXT_CACHE_BYTES = int(os.getenv("CONTEXT_CACHE_BYTES", str(64 * 1024 * 1024)))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+COMPLETION_CACHE_BYTES = int(
+    os.getenv("COMPLETION_CACHE_BYTES", str(16 * 1024 * 1024))
+)
+COMPLETION_CACHE_TTL = float(os.getenv("COMPLETION_CACHE_TTL", "86400"))
+COMPLETION_CACHE_PATH = os.getenv("COMPLETION_CACHE_PATH", "")
+COMPLETION_CACHE_SAVE_INTERVAL = float(
+    os.getenv("COMPLETION_CACHE_SAVE_INTERVAL", "300")
+)
+COMPLETION_CACHE_TITLES = os.getenv("COMPLETION_CACHE_TITLES", "true").lower() == "true"
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "3"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "65536"))
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", "4"))
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", "2"))
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "64"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+# A SQLite connection is a local file handle, there is nothing to ping
+DB_POOL_PRE_PING = (
+    os.getenv(
+        "DB_POOL_PRE_PING", "false" if DB_URL.startswith("sqlite") else "true"
+    ).lower()
+    == "true"
+)
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-20000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+UPSTREAM_URL = os.getenv("UPSTREAM_URL", "https://ai.hackclub.com")
+UPSTREAM_LIMIT = int(os.getenv("UPSTREAM_LIMIT", "100"))
+UPSTREAM_LIMIT_PER_HOST = int(os.getenv("UPSTREAM_LIMIT_PER_HOST", "50"))
+UPSTREAM_KEEPALIVE = float(os.getenv("UPSTREAM_KEEPALIVE", "30"))
+UPSTREAM_DNS_TTL = int(os.getenv("UPSTREAM_DNS_TTL", "300"))
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("UPSTREAM_RETRY_BACKOFF", "0.25"))
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "50"))
+UPSTREAM_QUEUE_SIZE = int(os.getenv("UPSTREAM_QUEUE_SIZE", "256"))
+UPSTREAM_QUEUE_LIMITS = os.getenv(
+    "UPSTREAM_QUEUE_LIMITS", "interactive=256,regeneration=128,background=32"
+)
+UPSTREAM_QUEUE_TIMEOUT = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "30"))
+CHAT_CONNECT_TIMEOUT = float(os.getenv("CHAT_CONNECT_TIMEOUT", "5"))
+CHAT_FIRST_BYTE_TIMEOUT = float(os.getenv("CHAT_FIRST_BYTE_TIMEOUT", "120"))
+CHAT_TOTAL_TIMEOUT = float(os.getenv("CHAT_TOTAL_TIMEOUT", "300"))
+TITLE_CONNECT_TIMEOUT = float(os.getenv("TITLE_CONNECT_TIMEOUT", "5"))
+TITLE_FIRST_BYTE_TIMEOUT = float(os.getenv("TITLE_FIRST_BYTE_TIMEOUT", "15"))
+TITLE_TOTAL_TIMEOUT = float(os.getenv("TITLE_TOTAL_TIMEOUT", "30"))
+MODEL_CATALOG_TTL = float(os.getenv("MODEL_CATALOG_TTL", "300"))
+MODEL_CATALOG_RETRY = float(os.getenv("MODEL_CATALOG_RETRY", "30"))
+CONTEXT_STRATEGY = os.getenv("CONTEXT_STRATEGY", "token_window")
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "20"))
+CONTEXT_TOKENS = int(os.getenv("CONTEXT_TOKENS", "32768"))
+CONTEXT_RESERVE_TOKENS = int(os.getenv("CONTEXT_RESERVE_TOKENS", "8192"))
+MODEL_CONTEXT_TOKENS = os.getenv(
+    "MODEL_CONTEXT_TOKENS",
+    "qwen/qwen3-32b=131072,"
+    "openai/gpt-oss-120b=131072,"
+    "openai/gpt-oss-20b=131072,"
+    "meta-llama/llama-4-maverick-17b-128e-instruct=131072",
+)
+BLOB_STORAGE = os.getenv("BLOB_STORAGE", "true").lower() == "true"
+BLOB_MIN_BYTES = int(os.getenv("BLOB_MIN_BYTES", "256"))
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+RATE_LIMIT_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_MINUTE", "20"))
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "10"))
+MODEL_RATE_COSTS = os.getenv("MODEL_RATE_COSTS", "")
+RATE_LIMIT_MAX_USERS = int(os.getenv("RATE_LIMIT_MAX_USERS", "100000"))
+USER_MAX_GENERATIONS = int(os.getenv("USER_MAX_GENERATIONS", "2"))
+MODEL_MAX_GENERATIONS = os.getenv("MODEL_MAX_GENERATIONS", "")
+MAX_GENERATIONS = int(os.getenv("MAX_GENERATIONS", "64"))
@@ -42,3 +42,27 @@ class WrongModel(Exception): ...
 
 
 class EmptyResponse(Exception): ...
+
+
+class InvalidCursor(Exception): ...
+
+
+class UpstreamUnavailable(Exception): ...
+
+
+class UpstreamBusy(UpstreamUnavailable): ...
+
+
+class UpstreamRejected(UpstreamUnavailable):
+    """The upstream refused the request itself, a 4xx other than 429."""
+
+    def __init__(self, status: int) -> None:
+        super().__init__(status)
+        self.status = status
+
+
+class RateLimited(Exception):
+    def __init__(self, reason: str, retry_after: float) -> None:
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
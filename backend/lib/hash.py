@@ -1,10 +1,26 @@
-from typing import Callable
+from asyncio import Semaphore, get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+from typing import Callable, TypeVar
 
 from argon2 import PasswordHasher
+from pydantic import BaseModel
 
-from lib.env import USE_HASH as use_hash_func
+from lib.env import (
+    ARGON2_MEMORY_COST,
+    ARGON2_PARALLELISM,
+    ARGON2_TIME_COST,
+    HASH_MAX_PENDING,
+    HASH_WORKERS,
+    USE_HASH as use_hash_func,
+)
 
-argon2_hasher = PasswordHasher()
+argon2_hasher = PasswordHasher(
+    time_cost=ARGON2_TIME_COST,
+    memory_cost=ARGON2_MEMORY_COST,
+    parallelism=ARGON2_PARALLELISM,
+)
 
 hash_func: Callable[[str], str] = \
     argon2_hasher.hash \
@@ -20,3 +36,106 @@ verify_func: Callable[[str, str], bool] = \
     if use_hash_func else \
     simple_verify
 
+
+"""
+EXECUTOR
+"""
+
+T = TypeVar("T")
+
+
+class HashStats(BaseModel):
+    workers: int
+    queued: int
+    running: int
+    completed: int
+    wait_seconds_total: float
+    wait_seconds_max: float
+    run_seconds_total: float
+    run_seconds_max: float
+
+
+# argon2 is CPU bound and releases the GIL, so hashing runs in its own threads
+# instead of blocking the event loop. At most HASH_MAX_PENDING jobs are handed
+# to the pool, the others wait on the semaphore.
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash")
+_pending = Semaphore(HASH_MAX_PENDING)
+_stats_lock = Lock()
+_stats = HashStats(
+    workers=HASH_WORKERS,
+    queued=0,
+    running=0,
+    completed=0,
+    wait_seconds_total=0,
+    wait_seconds_max=0,
+    run_seconds_total=0,
+    run_seconds_max=0,
+)
+
+
+class _QueuedJob:
+    """Counted in `queued` until it starts or its caller gives up on it."""
+
+    def __init__(self) -> None:
+        self.queued_at = perf_counter()
+        self.queued = True
+        with _stats_lock:
+            _stats.queued += 1
+
+    def leave_queue(self) -> None:
+        """Called with `_stats_lock` held, counts once whoever calls first."""
+        if self.queued:
+            self.queued = False
+            _stats.queued -= 1
+
+
+def _timed(func: Callable[..., T], job: _QueuedJob, *args: str) -> T:
+    started_at = perf_counter()
+    wait = started_at - job.queued_at
+    with _stats_lock:
+        job.leave_queue()
+        _stats.running += 1
+        _stats.wait_seconds_total += wait
+        _stats.wait_seconds_max = max(_stats.wait_seconds_max, wait)
+
+    try:
+        return func(*args)
+
+    finally:
+        run = perf_counter() - started_at
+        with _stats_lock:
+            _stats.running -= 1
+            _stats.completed += 1
+            _stats.run_seconds_total += run
+            _stats.run_seconds_max = max(_stats.run_seconds_max, run)
+
+
+async def _run(func: Callable[..., T], *args: str) -> T:
+    if not use_hash_func:
+        return func(*args)
+
+    # Cancelled while waiting on the semaphore, or before a worker picked the
+    # job up, `_timed` never runs
+    job = _QueuedJob()
+    try:
+        async with _pending:
+            return await get_running_loop().run_in_executor(
+                _executor, _timed, func, job, *args
+            )
+
+    finally:
+        with _stats_lock:
+            job.leave_queue()
+
+
+async def hash_async(password: str) -> str:
+    return await _run(hash_func, password)
+
+
+async def verify_async(hashed: str, password: str) -> bool:
+    return await _run(verify_func, hashed, password)
+
+
+def hash_stats() -> HashStats:
+    with _stats_lock:
+        return _stats.model_copy()
@@ -0,0 +1,188 @@
+from time import monotonic
+from typing import NamedTuple
+
+from lib.cache import LRUCache
+from lib.env import (
+    MAX_GENERATIONS,
+    MODEL_MAX_GENERATIONS,
+    MODEL_RATE_COSTS,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_MAX_USERS,
+    RATE_LIMIT_PER_MINUTE,
+    USER_MAX_GENERATIONS,
+)
+from lib.errors import RateLimited
+from lib.metrics import rate_limited
+
+# Nobody knows when a generation slot frees up, ask to retry soon
+CONCURRENCY_RETRY_AFTER = 1.0
+
+
+class RateLimit(NamedTuple):
+    per_minute: float  # 0 disables the limit
+    burst: float
+
+    @property
+    def per_second(self) -> float:
+        return self.per_minute / 60
+
+    @property
+    def refill_seconds(self) -> float:
+        """Time for an empty bucket to be full again."""
+        return self.burst / self.per_second if self.per_minute else 0
+
+
+def _parse_costs(raw: str) -> dict[str, float]:
+    """`model=cost` pairs separated by `,`."""
+    costs: dict[str, float] = {}
+    for item in raw.split(","):
+        model_id, _, cost = item.strip().rpartition("=")
+        if model_id and cost:
+            costs[model_id] = float(cost)
+    return costs
+
+
+def _parse_counts(raw: str) -> dict[str, int]:
+    counts: dict[str, int] = {}
+    for item in raw.split(","):
+        model_id, _, count = item.strip().rpartition("=")
+        if model_id and count:
+            counts[model_id] = int(count)
+    return counts
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated_at")
+
+    def __init__(self, tokens: float, now: float) -> None:
+        self.tokens = tokens
+        self.updated_at = now
+
+    def refill(self, limit: RateLimit, now: float) -> None:
+        self.tokens = min(
+            limit.burst, self.tokens + (now - self.updated_at) * limit.per_second
+        )
+        self.updated_at = now
+
+    def wait(self, limit: RateLimit, cost: float) -> float:
+        """Seconds until `cost` tokens are available, 0 if they are."""
+        return max(cost - self.tokens, 0) / limit.per_second
+
+
+class GenerationSlot:
+    """A running generation, counted until `release` (or the `with` block) ends."""
+
+    def __init__(self, limiter: "GenerationLimiter", user_id: str, model_id: str):
+        self._limiter = limiter
+        self.user_id = user_id
+        self.model_id = model_id
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self._limiter._release(self)
+
+    def __enter__(self) -> "GenerationSlot":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.release()
+
+
+class GenerationLimiter:
+    """
+    Admission control for completions: a token bucket per user, which an answer
+    of a model takes its cost from (1 unless set), and caps on generations
+    running at once per user, per model and overall. A rejection raises
+    `RateLimited` right away, nothing waits.
+
+    Buckets live in an LRU bounded by `max_users`. A bucket idle for its refill
+    time is full, the same as a new one, so it expires then. Running counts
+    only hold users and models with something running. Everything is O(1).
+    """
+
+    def __init__(
+        self,
+        limit: RateLimit,
+        model_costs: dict[str, float],
+        user_max: int,
+        model_max: dict[str, int],
+        global_max: int,
+        max_users: int,
+    ) -> None:
+        for model_id, cost in model_costs.items():
+            if limit.per_minute and cost > limit.burst:
+                raise ValueError(f"{model_id} costs more than the burst of a bucket")
+
+        self.limit = limit
+        self.model_costs = model_costs
+        self.user_max = user_max
+        self.model_max = model_max
+        self.global_max = global_max
+        self.buckets: LRUCache[str, TokenBucket] = LRUCache(
+            max_items=max_users, ttl=limit.refill_seconds or None
+        )
+        self.running = 0
+        self.running_per_user: dict[str, int] = {}
+        self.running_per_model: dict[str, int] = {}
+
+    def cost_of(self, model_id: str) -> float:
+        return self.model_costs.get(model_id, 1)
+
+    def _reject(self, reason: str, model_id: str, retry_after: float):
+        rate_limited.inc(reason, model_id)
+        return RateLimited(reason, retry_after)
+
+    def acquire(self, user_id: str, model_id: str) -> GenerationSlot:
+        if self.global_max and self.running >= self.global_max:
+            raise self._reject("global", model_id, CONCURRENCY_RETRY_AFTER)
+
+        model_max = self.model_max.get(model_id, 0)
+        if model_max and self.running_per_model.get(model_id, 0) >= model_max:
+            raise self._reject("model", model_id, CONCURRENCY_RETRY_AFTER)
+
+        if self.user_max and self.running_per_user.get(user_id, 0) >= self.user_max:
+            raise self._reject("user", model_id, CONCURRENCY_RETRY_AFTER)
+
+        limit = self.limit
+        if limit.per_minute:
+            now = monotonic()
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = TokenBucket(limit.burst, now)
+            else:
+                bucket.refill(limit, now)
+            # Set again so the expiry counts from the last use
+            self.buckets.set(user_id, bucket)
+
+            cost = self.cost_of(model_id)
+            wait = bucket.wait(limit, cost)
+            if wait:
+                raise self._reject("rate", model_id, wait)
+            bucket.tokens -= cost
+
+        self.running += 1
+        self.running_per_user[user_id] = self.running_per_user.get(user_id, 0) + 1
+        self.running_per_model[model_id] = self.running_per_model.get(model_id, 0) + 1
+        return GenerationSlot(self, user_id, model_id)
+
+    def _release(self, slot: GenerationSlot) -> None:
+        self.running -= 1
+        for counts, key in (
+            (self.running_per_user, slot.user_id),
+            (self.running_per_model, slot.model_id),
+        ):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+
+
+generation_limiter = GenerationLimiter(
+    RateLimit(RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST),
+    _parse_costs(MODEL_RATE_COSTS),
+    USER_MAX_GENERATIONS,
+    _parse_counts(MODEL_MAX_GENERATIONS),
+    MAX_GENERATIONS,
+    RATE_LIMIT_MAX_USERS,
+)
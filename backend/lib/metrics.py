@@ -0,0 +1,373 @@
+import math
+from abc import ABC, abstractmethod
+from asyncio import CancelledError, Task, create_task, sleep
+from contextvars import ContextVar
+from threading import Lock
+from time import perf_counter
+from typing import Iterable
+
+from starlette.routing import Match
+
+from lib.env import LOOP_LAG_INTERVAL
+
+"""
+PRIMITIVES
+
+Just enough of the Prometheus data model to render the text exposition format,
+without pulling a client library in. Values are updated from the event loop;
+the lock only matters for the hash executor threads.
+"""
+
+LabelValues = tuple[str, ...]
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+UPSTREAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60, 120)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+USAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    type = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = Lock()
+
+    def _key(self, labels: LabelValues) -> LabelValues:
+        if labels.__len__() != self.labels.__len__():
+            raise ValueError(f"{self.name} takes labels {self.labels}")
+        return labels
+
+    @abstractmethod
+    def samples(self) -> Iterable[str]: ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def set(self, *labels: str, value: float) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = (*sorted(buckets), math.inf)
+        # labels -> (count per bucket, sum)
+        self._values: dict[LabelValues, tuple[list[int], list[float]]] = {}
+
+    def observe(self, *labels: str, value: float) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                key, ([0] * self.buckets.__len__(), [0.0])
+            )
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            total[0] += value
+
+    def samples(self) -> Iterable[str]:
+        names = (*self.labels, "le")
+        for labels, (counts, total) in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                label_text = _format_labels(names, (*labels, _format_value(bound)))
+                yield f"{self.name}_bucket{label_text} {cumulative}"
+            label_text = _format_labels(self.labels, labels)
+            yield f"{self.name}_sum{label_text} {_format_value(total[0])}"
+            yield f"{self.name}_count{label_text} {cumulative}"
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))  # type: ignore
+
+    def gauge(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, help, labels))  # type: ignore
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, help, labels, buckets))  # type: ignore
+
+    def render(self, extra: Iterable[Metric] = ()) -> str:
+        metrics = [*self.metrics.values(), *extra]
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+
+"""
+METRICS
+
+Updated where things happen. Numbers the app already keeps (pool, hash
+executor, caches, upstream retries) are read at scrape time by `/metrics`.
+"""
+
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds",
+    "Time to answer a request, until the last byte of the body",
+    ("method", "route", "status"),
+)
+http_requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "Requests being answered", ("method", "route")
+)
+db_queries_per_request = registry.histogram(
+    "db_queries_per_request",
+    "Database statements run while answering a request",
+    ("method", "route"),
+    COUNT_BUCKETS,
+)
+db_query_duration = registry.histogram(
+    "db_query_duration_seconds",
+    "Database statement latency, by the route it ran for",
+    ("route",),
+    QUERY_BUCKETS,
+)
+upstream_request_duration = registry.histogram(
+    "upstream_request_duration_seconds",
+    "Upstream call latency including reading the body (the whole stream when"
+    " streamed), by kind of call and model",
+    ("kind", "model", "outcome"),
+    UPSTREAM_BUCKETS,
+)
+upstream_queue_time = registry.histogram(
+    "upstream_queue_time_seconds",
+    "`usage.queue_time` reported by the upstream",
+    ("model",),
+    USAGE_BUCKETS,
+)
+upstream_prompt_time = registry.histogram(
+    "upstream_prompt_time_seconds",
+    "`usage.prompt_time` reported by the upstream",
+    ("model",),
+    USAGE_BUCKETS,
+)
+upstream_completion_time = registry.histogram(
+    "upstream_completion_time_seconds",
+    "`usage.completion_time` reported by the upstream",
+    ("model",),
+    USAGE_BUCKETS,
+)
+upstream_tokens = registry.counter(
+    "upstream_tokens_total",
+    "Tokens reported by the upstream, by model and kind (prompt / completion)",
+    ("model", "type"),
+)
+upstream_dispatch_wait = registry.histogram(
+    "upstream_dispatch_wait_seconds",
+    "Time upstream calls waited for a dispatcher slot, by priority",
+    ("priority",),
+    USAGE_BUCKETS,
+)
+upstream_shed = registry.counter(
+    "upstream_shed_total",
+    "Upstream calls dropped by the dispatcher, by priority and reason (full,"
+    " evicted, timeout)",
+    ("priority", "reason"),
+)
+rate_limited = registry.counter(
+    "rate_limited_total",
+    "Generations refused with a 429, by reason (rate, user, model, global)",
+    ("reason", "model"),
+)
+event_loop_lag = registry.histogram(
+    "event_loop_lag_seconds",
+    f"How late a {LOOP_LAG_INTERVAL}s sleep on the event loop wakes up",
+    buckets=LAG_BUCKETS,
+)
+
+
+def observe_usage(model: str, usage) -> None:
+    """Export the `usage` block of a completion (an `APIUsageReponse`)."""
+    upstream_queue_time.observe(model, value=usage.queue_time)
+    upstream_prompt_time.observe(model, value=usage.prompt_time)
+    upstream_completion_time.observe(model, value=usage.completion_time)
+    upstream_tokens.inc(model, "prompt", amount=usage.prompt_tokens)
+    upstream_tokens.inc(model, "completion", amount=usage.completion_tokens)
+
+
+"""
+REQUESTS
+"""
+
+
+class RequestMetrics:
+    __slots__ = ("route", "queries")
+
+    def __init__(self, route: str = "unmatched") -> None:
+        self.route = route
+        self.queries = 0
+
+
+# Set for the duration of every HTTP request, read by the engine listeners in
+# `lib.db`. Streaming responses keep it, they run inside the request.
+current_request: ContextVar[RequestMetrics | None] = ContextVar(
+    "current_request", default=None
+)
+
+
+def observe_query(elapsed: float) -> None:
+    request = current_request.get()
+    if request is None:
+        db_query_duration.observe("background", value=elapsed)
+        return
+    request.queries += 1
+    db_query_duration.observe(request.route, value=elapsed)
+
+
+def _route_template(scope) -> str:
+    app = scope.get("app")
+    for route in getattr(getattr(app, "router", None), "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "unmatched")
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request. Routes are labelled with their template
+    (`/ai/conversation`), requests matching no route as `unmatched`, so
+    scanners cannot blow the label set up.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        request = RequestMetrics(_route_template(scope))
+        token = current_request.set(request)
+        status = "500"
+
+        async def _send(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        started_at = perf_counter()
+        http_requests_in_flight.inc(method, request.route)
+        try:
+            await self.app(scope, receive, _send)
+
+        finally:
+            http_requests_in_flight.dec(method, request.route)
+            current_request.reset(token)
+            http_request_duration.observe(
+                method, request.route, status, value=perf_counter() - started_at
+            )
+            db_queries_per_request.observe(
+                method, request.route, value=request.queries
+            )
+
+
+"""
+EVENT LOOP LAG
+"""
+
+_lag_task: Task[None] | None = None
+
+
+async def _watch_loop_lag() -> None:
+    while True:
+        started_at = perf_counter()
+        await sleep(LOOP_LAG_INTERVAL)
+        event_loop_lag.observe(
+            value=max(perf_counter() - started_at - LOOP_LAG_INTERVAL, 0)
+        )
+
+
+def start() -> None:
+    global _lag_task
+    if not _lag_task:
+        _lag_task = create_task(_watch_loop_lag())
+
+
+async def stop() -> None:
+    global _lag_task
+    if not _lag_task:
+        return
+
+    _lag_task.cancel()
+    try:
+        await _lag_task
+
+    except CancelledError:
+        ...
+
+    _lag_task = None
@@ -0,0 +1,329 @@
+"""
+Versioned schema migrations.
+
+A fresh database is created from the models and stamped with the latest
+version. An existing one gets every migration newer than its `schema_version`,
+in order, inside the startup transaction. To change the schema, update the
+models and append a `Migration` to `MIGRATIONS`. Write its DDL out literally,
+and give it its own `table()` shapes and copies of the helpers it needs: a
+migration must do the same thing whatever the models and `lib.db` look like
+later.
+
+    python migrate.py          # upgrade the database in DB_URL
+    python migrate.py check    # also check hot query plans, see lib.query_plans
+"""
+
+import hashlib
+import logging
+from typing import Callable, NamedTuple
+
+from sqlalchemy import (
+    JSON,
+    Column,
+    Connection,
+    DateTime,
+    Integer,
+    String,
+    Table,
+    and_,
+    bindparam,
+    column,
+    exists,
+    func,
+    insert,
+    inspect,
+    select,
+    table,
+    text,
+    update,
+)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import SQLModel
+
+from lib.env import BLOB_MIN_BYTES, BLOB_STORAGE
+
+logger = logging.getLogger(__name__)
+
+schema_version = Table(
+    "schema_version",
+    SQLModel.metadata,
+    Column("version", Integer, nullable=False),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+def _execute(*statements: str) -> Callable[[Connection], None]:
+    def _upgrade(conn: Connection):
+        for statement in statements:
+            conn.execute(text(statement))
+
+    return _upgrade
+
+
+def _datetime_type(conn: Connection) -> str:
+    """Column type `create_all` gives a naive `datetime` field."""
+    if conn.dialect.name == "postgresql":
+        return "TIMESTAMP WITHOUT TIME ZONE"
+    return "DATETIME"
+
+
+def _backfill_message_ancestors(conn: Connection):
+    message = table(
+        "message",
+        column("id", String),
+        column("path", JSON),
+        column("created_at", DateTime),
+    )
+    ancestor = table(
+        "message_ancestor",
+        column("ancestor_id", String),
+        column("descendant_id", String),
+        column("depth", Integer),
+        column("created_at", DateTime),
+    )
+    statement = select(message.c.id, message.c.path, message.c.created_at).where(
+        ~exists().where(
+            ancestor.c.ancestor_id == message.c.id,
+            ancestor.c.descendant_id == message.c.id,
+        )
+    )
+    rows = [
+        {
+            "ancestor_id": ancestor_id,
+            "descendant_id": message_id,
+            "depth": path.__len__() - 1 - index,
+            "created_at": created_at,
+        }
+        for message_id, path, created_at in conn.execute(statement).all()
+        for index, ancestor_id in enumerate(path)
+    ]
+    if rows:
+        conn.execute(insert(ancestor), rows)
+
+
+def _preview(role: str, content: str) -> str:
+    """`lib.db.message_preview` as of migration 4."""
+    if role == "system":
+        return ""
+    return " ".join(content.split())[:120]
+
+
+def _backfill_conversation_summaries(conn: Connection):
+    message = table(
+        "message",
+        column("id", String),
+        column("conversation_id", String),
+        column("role", String),
+        column("content", String),
+        column("created_at", DateTime),
+    )
+    conversation = table(
+        "conversation",
+        column("id", String),
+        column("created_at", DateTime),
+        column("updated_at", DateTime),
+        column("message_count", Integer),
+        column("head_message_id", String),
+        column("preview", String),
+    )
+    latest = (
+        select(
+            message.c.conversation_id,
+            func.count().label("message_count"),
+            func.max(message.c.created_at).label("updated_at"),
+        )
+        .group_by(message.c.conversation_id)
+        .subquery()
+    )
+    statement = select(
+        latest.c.conversation_id,
+        latest.c.message_count,
+        latest.c.updated_at,
+        message.c.id,
+        message.c.role,
+        message.c.content,
+    ).join(
+        message,
+        and_(
+            message.c.conversation_id == latest.c.conversation_id,
+            message.c.created_at == latest.c.updated_at,
+        ),
+    )
+    rows = {
+        conversation_id: {
+            "_id": conversation_id,
+            "updated_at": updated_at,
+            "message_count": message_count,
+            "head_message_id": message_id,
+            "preview": _preview(role, content),
+        }
+        for conversation_id, message_count, updated_at, message_id, role, content in (
+            conn.execute(statement).all()
+        )
+    }
+
+    conn.execute(update(conversation).values(updated_at=conversation.c.created_at))
+    if rows:
+        conn.execute(
+            update(conversation).where(conversation.c.id == bindparam("_id")),
+            list(rows.values()),
+        )
+
+
+def _upgrade_conversation_summaries(conn: Connection):
+    # A NOT NULL column needs a constant default for the existing rows
+    _execute(
+        f"ALTER TABLE conversation ADD COLUMN updated_at {_datetime_type(conn)} "
+        "NOT NULL DEFAULT '1970-01-01 00:00:00'",
+        "ALTER TABLE conversation ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE conversation ADD COLUMN head_message_id VARCHAR",
+        "ALTER TABLE conversation ADD COLUMN preview VARCHAR NOT NULL DEFAULT ''",
+    )(conn)
+    _backfill_conversation_summaries(conn)
+    _execute(
+        "CREATE INDEX IF NOT EXISTS ix_conversation_user_updated_id "
+        "ON conversation (user_id, updated_at, id)",
+    )(conn)
+
+
+def _store_body(conn: Connection, body: str | None) -> tuple[str | None, str | None]:
+    """`lib.db.store_body` as of migration 7: `(column value, hash)`."""
+    if not BLOB_STORAGE or not body or body.encode().__len__() < BLOB_MIN_BYTES:
+        return body, None
+
+    blob = table("blob", column("hash", String), column("body", String))
+    if conn.dialect.name == "postgresql":
+        insert_blob = postgresql_insert
+    else:
+        insert_blob = sqlite_insert
+    hash = hashlib.sha256(body.encode()).hexdigest()
+    conn.execute(
+        insert_blob(blob).values(hash=hash, body=body).on_conflict_do_nothing()
+    )
+    return "", hash
+
+
+def _move_bodies_to_blobs(conn: Connection):
+    message = table(
+        "message",
+        column("id", String),
+        column("content", String),
+        column("content_hash", String),
+        column("reasoning", String),
+        column("reasoning_hash", String),
+    )
+    # Keyset batches, never every message at once
+    last_id = ""
+    while True:
+        rows = conn.execute(
+            select(message.c.id, message.c.content, message.c.reasoning)
+            .where(message.c.id > last_id)
+            .order_by(message.c.id)
+            .limit(500)
+        ).all()
+        if not rows:
+            break
+
+        last_id = rows[-1][0]
+        for id, content, reasoning in rows:
+            content, content_hash = _store_body(conn, content)
+            reasoning, reasoning_hash = _store_body(conn, reasoning)
+            if content_hash or reasoning_hash:
+                conn.execute(
+                    update(message)
+                    .where(message.c.id == id)
+                    .values(
+                        content=content,
+                        content_hash=content_hash,
+                        reasoning=reasoning,
+                        reasoning_hash=reasoning_hash,
+                    )
+                )
+
+
+def _upgrade_blobs(conn: Connection):
+    # The same foreign keys as `create_all`, SQLite takes them on ADD COLUMN
+    # when the default is NULL
+    _execute(
+        "ALTER TABLE message ADD COLUMN content_hash VARCHAR REFERENCES blob (hash)",
+        "ALTER TABLE message ADD COLUMN reasoning_hash VARCHAR REFERENCES blob (hash)",
+        "CREATE INDEX IF NOT EXISTS ix_message_content_hash ON message (content_hash)",
+        "CREATE INDEX IF NOT EXISTS ix_message_reasoning_hash "
+        "ON message (reasoning_hash)",
+    )(conn)
+    _move_bodies_to_blobs(conn)
+
+
+MIGRATIONS: list[Migration] = [
+    Migration(1, "backfill message_ancestor", _backfill_message_ancestors),
+    Migration(
+        2,
+        "indexes for hot filters",
+        _execute(
+            "CREATE INDEX IF NOT EXISTS ix_message_conversation_created "
+            "ON message (conversation_id, created_at)",
+            "CREATE INDEX IF NOT EXISTS ix_message_parent ON message (parent_id)",
+            "CREATE INDEX IF NOT EXISTS ix_conversation_user_created "
+            "ON conversation (user_id, created_at)",
+            'CREATE INDEX IF NOT EXISTS ix_user_username ON "user" (username)',
+        ),
+    ),
+    Migration(
+        3,
+        "conversation keyset pagination index",
+        _execute(
+            "DROP INDEX IF EXISTS ix_conversation_user_created",
+            "CREATE INDEX IF NOT EXISTS ix_conversation_user_created_id "
+            "ON conversation (user_id, created_at, id)",
+        ),
+    ),
+    Migration(4, "conversation summaries", _upgrade_conversation_summaries),
+    Migration(
+        5,
+        "indexes for branch info",
+        _execute(
+            "DROP INDEX IF EXISTS ix_message_parent",
+            "CREATE INDEX IF NOT EXISTS ix_message_parent_created "
+            "ON message (parent_id, created_at, id)",
+            "CREATE INDEX IF NOT EXISTS ix_message_ancestor_descendant_depth "
+            "ON message_ancestor (descendant_id, depth)",
+        ),
+    ),
+    Migration(
+        6,
+        "conversation version",
+        _execute(
+            "ALTER TABLE conversation ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+        ),
+    ),
+    Migration(7, "content addressed message bodies", _upgrade_blobs),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def migrate(conn: Connection) -> int:
+    """Create missing tables and run pending migrations, return the version."""
+    fresh = not inspect(conn).has_table("message")
+    SQLModel.metadata.create_all(conn)
+
+    current = conn.execute(select(schema_version.c.version)).scalar()
+    if current is None:
+        current = LATEST_VERSION if fresh else 0
+        conn.execute(insert(schema_version).values(version=current))
+
+    for migration in MIGRATIONS:
+        if migration.version <= current:
+            continue
+
+        logger.info("migrating to %d: %s", migration.version, migration.description)
+        migration.upgrade(conn)
+        conn.execute(update(schema_version).values(version=migration.version))
+        current = migration.version
+
+    return current
@@ -0,0 +1,122 @@
+"""
+`EXPLAIN QUERY PLAN` of the statements behind the hot paths, compiled from the
+same builders `lib.db` runs them with, so the check follows the code.
+
+    python migrate.py check
+"""
+
+from datetime import date, datetime
+from typing import NamedTuple
+
+from sqlalchemy import Connection, text
+from sqlalchemy.sql import Executable
+
+from lib.db import (
+    _branch_delta_statement,
+    _branch_info_statement,
+    _children_statement,
+    _context_statement,
+    _conversations_statement,
+    _delete_orphan_blobs_statement,
+    _latest_message_statement,
+    _stamp_statement,
+    _summaries_statement,
+    _usage_statement,
+    _user_by_username_statement,
+)
+
+# Values bound into the statements, any will do for the plan
+ID = "x"
+AT = datetime(2000, 1, 1)
+DAY = date(2000, 1, 1)
+
+
+class HotQuery(NamedTuple):
+    name: str
+    statement: Executable
+    indexes: tuple[str, ...]  # the plan must use every one of them
+
+
+HOT_QUERIES: list[HotQuery] = [
+    HotQuery(
+        "conversation context",
+        _context_statement(ID),
+        ("ix_message_ancestor_descendant_depth",),
+    ),
+    HotQuery(
+        "branch info",
+        _branch_info_statement(ID),
+        ("ix_message_ancestor_descendant_depth", "ix_message_parent_created"),
+    ),
+    HotQuery(
+        "branch delta",
+        _branch_delta_statement(ID, ID),
+        ("ix_message_ancestor_descendant_depth", "ix_message_parent_created"),
+    ),
+    HotQuery("children", _children_statement(ID), ("ix_message_parent_created",)),
+    HotQuery(
+        "latest message",
+        _latest_message_statement(ID),
+        ("ix_message_conversation_created",),
+    ),
+    HotQuery(
+        "latest message under another",
+        _latest_message_statement(ID, ID),
+        ("ix_message_ancestor_ancestor_created",),
+    ),
+    HotQuery(
+        "conversations page",
+        _conversations_statement(ID, (AT, ID), limit=50),
+        ("ix_conversation_user_created_id",),
+    ),
+    HotQuery(
+        "conversation summaries page",
+        _summaries_statement(ID, (AT, ID), limit=50),
+        ("ix_conversation_user_updated_id",),
+    ),
+    HotQuery(
+        "conversation list stamp",
+        _stamp_statement(ID),
+        ("sqlite_autoindex_conversation_list_version_1",),
+    ),
+    HotQuery(
+        "orphan blobs",
+        _delete_orphan_blobs_statement([ID]),
+        ("ix_message_content_hash", "ix_message_reasoning_hash"),
+    ),
+    HotQuery(
+        "usage of a user",
+        _usage_statement(["day"], DAY, DAY, ID),
+        ("ix_usage_daily_user_day",),
+    ),
+    HotQuery("user by name", _user_by_username_statement(ID), ("ix_user_username",)),
+]
+
+
+def check_query_plans(conn: Connection) -> list[str]:
+    """
+    Run `EXPLAIN QUERY PLAN` on `HOT_QUERIES` and return the problems found: a
+    query not using its indexes, scanning a whole table or sorting in a
+    temporary b-tree. SQLite only.
+    """
+    if conn.dialect.name != "sqlite":
+        return []
+
+    problems: list[str] = []
+    for name, statement, indexes in HOT_QUERIES:
+        query = str(
+            statement.compile(
+                dialect=conn.dialect, compile_kwargs={"literal_binds": True}
+            )
+        )
+        plan = [row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + query))]
+        for index in indexes:
+            if not any(index in step for step in plan):
+                problems.append(f"{name} does not use {index}: {plan}")
+        # `SCAN (subquery-1)` reads a CTE, `SCAN message` the whole table
+        if any(step.startswith("SCAN ") and "(" not in step for step in plan):
+            problems.append(f"{name} scans a whole table: {plan}")
+        if any("TEMP B-TREE" in step for step in plan):
+            problems.append(f"{name} sorts in a temporary b-tree: {plan}")
+
+    return problems
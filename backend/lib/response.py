@@ -21,6 +21,19 @@ def MESSAGE_OK() -> dict[str, Any]:
     )
 
 
+def SSE_STREAM() -> dict[str, Any]:
+    return {
+        "content": {
+            "text/event-stream": {
+                "schema": {"type": "string"},
+                "example": 'event: delta\ndata: {"content": "Hi", "reasoning": ""}\n\n',
+            }
+        },
+        "description": "Events: `conversation`, `title`, `user`, `delta`, "
+        "`model`, `error`, `done`",
+    }
+
+
 def MESSAGE_UPDATE(
     field: str, model: BaseModel | None = None, ref: str | None = None
 ) -> dict[str, Any]:
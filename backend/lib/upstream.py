@@ -0,0 +1,370 @@
+import logging
+from asyncio import CancelledError, Future, get_running_loop, sleep, timeout
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from random import uniform
+from time import perf_counter
+from typing import Any, AsyncIterator
+
+from aiohttp import (
+    ClientConnectionError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    SocketTimeoutError,
+    TCPConnector,
+)
+from pydantic import BaseModel, Field
+
+from lib.env import (
+    CHAT_CONNECT_TIMEOUT,
+    CHAT_FIRST_BYTE_TIMEOUT,
+    CHAT_TOTAL_TIMEOUT,
+    TITLE_CONNECT_TIMEOUT,
+    TITLE_FIRST_BYTE_TIMEOUT,
+    TITLE_TOTAL_TIMEOUT,
+    UPSTREAM_CONCURRENCY,
+    UPSTREAM_DNS_TTL,
+    UPSTREAM_KEEPALIVE,
+    UPSTREAM_LIMIT,
+    UPSTREAM_LIMIT_PER_HOST,
+    UPSTREAM_QUEUE_LIMITS,
+    UPSTREAM_QUEUE_SIZE,
+    UPSTREAM_QUEUE_TIMEOUT,
+    UPSTREAM_RETRIES,
+    UPSTREAM_RETRY_BACKOFF,
+    UPSTREAM_URL,
+)
+from lib.errors import RateLimited, UpstreamBusy, UpstreamRejected, UpstreamUnavailable
+from lib.metrics import upstream_dispatch_wait, upstream_request_duration, upstream_shed
+
+logger = logging.getLogger(__name__)
+
+# `sock_read` bounds the wait for the first byte of a plain completion, and the
+# gap between two chunks of a streamed one.
+CHAT_TIMEOUT = ClientTimeout(
+    total=CHAT_TOTAL_TIMEOUT,
+    connect=CHAT_CONNECT_TIMEOUT,
+    sock_read=CHAT_FIRST_BYTE_TIMEOUT,
+)
+TITLE_TIMEOUT = ClientTimeout(
+    total=TITLE_TOTAL_TIMEOUT,
+    connect=TITLE_CONNECT_TIMEOUT,
+    sock_read=TITLE_FIRST_BYTE_TIMEOUT,
+)
+MODELS_TIMEOUT = ClientTimeout(total=5)
+
+# Nothing was generated for these, so sending the request again is safe
+RETRY_STATUSES = {502, 503}
+# About our credentials, not the client's request: a gateway failure to it
+AUTH_STATUSES = {401, 403, 407}
+
+# Waiters leave the dispatcher queues as calls end, ask to retry soon
+BUSY_RETRY_AFTER = 1.0
+
+
+class UpstreamCallStats(BaseModel):
+    calls: int = Field(default=0)
+    errors: int = Field(default=0)
+    retries: int = Field(default=0)
+    seconds_total: float = Field(default=0)
+    seconds_max: float = Field(default=0)
+
+
+"""
+DISPATCHER
+"""
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # answers a user is waiting for
+    REGENERATION = 1  # answers to an edited / re-asked prompt
+    BACKGROUND = 2  # titles, model catalog
+
+    @property
+    def label(self) -> str:
+        return self.name.lower()
+
+
+def _parse_queue_limits(raw: str) -> dict[Priority, int]:
+    """`priority=size` pairs separated by `,`, missing ones are unbounded."""
+    limits: dict[Priority, int] = {}
+    for item in raw.split(","):
+        name, _, size = item.strip().partition("=")
+        if name and size:
+            limits[Priority[name.upper()]] = int(size)
+    return limits
+
+
+class DispatcherStats(BaseModel):
+    running: int
+    queued: dict[str, int]
+
+
+class UpstreamDispatcher:
+    """
+    Orders upstream calls when more than `concurrency` want to run at once. A
+    free slot goes to the oldest waiter of the highest priority. Each priority
+    has its own bounded queue, and all of them share `queue_size` places: once
+    those are taken, an arrival takes the place of the newest waiter of a lower
+    priority, or is refused when there is none. Both fail with `UpstreamBusy`,
+    as does a wait longer than `queue_timeout`.
+
+    Slots are handed from `release` to the next waiter directly, so a waiter
+    can only exist while every slot is taken. `concurrency` 0 disables it.
+    """
+
+    def __init__(
+        self,
+        concurrency: int,
+        queue_size: int,
+        queue_limits: dict[Priority, int],
+        queue_timeout: float,
+    ) -> None:
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_limits = queue_limits
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self.queues: dict[Priority, deque[Future[None]]] = {
+            priority: deque() for priority in Priority
+        }
+
+    def queued(self) -> int:
+        return sum(queue.__len__() for queue in self.queues.values())
+
+    def _shed(self, priority: Priority, reason: str) -> UpstreamBusy:
+        upstream_shed.inc(priority.label, reason)
+        return UpstreamBusy()
+
+    def _make_room(self, priority: Priority) -> None:
+        queue = self.queues[priority]
+        limit = self.queue_limits.get(priority)
+        if limit is not None and queue.__len__() >= limit:
+            raise self._shed(priority, "full")
+
+        if self.queued() < self.queue_size:
+            return
+
+        for lower in reversed(Priority):
+            if lower <= priority:
+                break
+            if self.queues[lower]:
+                self.queues[lower].pop().set_exception(self._shed(lower, "evicted"))
+                return
+
+        raise self._shed(priority, "full")
+
+    async def acquire(self, priority: Priority) -> None:
+        if not self.concurrency:
+            return
+
+        if self.running < self.concurrency:
+            self.running += 1
+            upstream_dispatch_wait.observe(priority.label, value=0)
+            return
+
+        self._make_room(priority)
+        waiter: Future[None] = get_running_loop().create_future()
+        self.queues[priority].append(waiter)
+        started_at = perf_counter()
+        try:
+            async with timeout(self.queue_timeout or None):
+                await waiter
+
+        except TimeoutError:
+            self._leave(priority, waiter)
+            raise self._shed(priority, "timeout")
+
+        except BaseException:
+            self._leave(priority, waiter)
+            raise
+
+        upstream_dispatch_wait.observe(
+            priority.label, value=perf_counter() - started_at
+        )
+
+    def _leave(self, priority: Priority, waiter: Future[None]) -> None:
+        """Clean up after a waiter that gave up, it may have been given a slot."""
+        if waiter.done() and not waiter.cancelled() and not waiter.exception():
+            self.release()
+            return
+
+        try:
+            self.queues[priority].remove(waiter)
+
+        except ValueError:
+            ...
+
+    def release(self) -> None:
+        if not self.concurrency:
+            return
+
+        for queue in self.queues.values():
+            while queue:
+                waiter = queue.popleft()
+                if not waiter.done():
+                    # The slot goes to the waiter, `running` stays the same
+                    waiter.set_result(None)
+                    return
+
+        self.running -= 1
+
+    def stats(self) -> DispatcherStats:
+        return DispatcherStats(
+            running=self.running,
+            queued={
+                priority.label: queue.__len__()
+                for priority, queue in self.queues.items()
+            },
+        )
+
+
+dispatcher = UpstreamDispatcher(
+    UPSTREAM_CONCURRENCY,
+    UPSTREAM_QUEUE_SIZE,
+    _parse_queue_limits(UPSTREAM_QUEUE_LIMITS),
+    UPSTREAM_QUEUE_TIMEOUT,
+)
+
+"""
+REQUEST
+"""
+
+session: ClientSession
+_stats: dict[str, UpstreamCallStats] = {}
+
+
+async def init() -> None:
+    global session
+    session = ClientSession(
+        UPSTREAM_URL,
+        connector=TCPConnector(
+            limit=UPSTREAM_LIMIT,
+            limit_per_host=UPSTREAM_LIMIT_PER_HOST,
+            keepalive_timeout=UPSTREAM_KEEPALIVE,
+            ttl_dns_cache=UPSTREAM_DNS_TTL,
+        ),
+    )
+
+
+async def close() -> None:
+    await session.close()
+
+
+def _backoff(attempt: int) -> float:
+    return uniform(0, UPSTREAM_RETRY_BACKOFF * 2**attempt)
+
+
+def _retry_after(response: ClientResponse) -> float:
+    """Seconds a 429 asks to wait, in seconds or as a date, or `BUSY_RETRY_AFTER`."""
+    value = response.headers.get("Retry-After", "")
+    try:
+        return max(float(value), 0)
+
+    except ValueError:
+        ...
+
+    try:
+        at = parsedate_to_datetime(value)
+        return max((at - datetime.now(timezone.utc)).total_seconds(), 0)
+
+    except (TypeError, ValueError):
+        return BUSY_RETRY_AFTER
+
+
+@asynccontextmanager
+async def request(
+    method: str,
+    path: str,
+    kind: str,
+    timeout: ClientTimeout,
+    model: str = "",
+    priority: Priority = Priority.INTERACTIVE,
+    **kwargs: Any,
+) -> AsyncIterator[ClientResponse]:
+    """
+    Send a request to the upstream and yield its response. Connection errors
+    and 502 / 503 answers are retried with jittered backoff, read timeouts are
+    not (the upstream may still be generating). Calls are timed per `kind`,
+    the time includes reading the body, so a whole stream for streamed calls.
+
+    The call first waits for a `dispatcher` slot at `priority`, and holds it
+    until the response is released (retries included).
+    """
+    await dispatcher.acquire(priority)
+    stats = _stats.setdefault(kind, UpstreamCallStats())
+    stats.calls += 1
+    started_at = perf_counter()
+    response: ClientResponse | None = None
+    outcome = "ok"
+    try:
+        for attempt in range(UPSTREAM_RETRIES + 1):
+            last_attempt = attempt == UPSTREAM_RETRIES
+            try:
+                response = await session.request(
+                    method, path, timeout=timeout, **kwargs
+                )
+
+            except SocketTimeoutError:
+                raise
+
+            except ClientConnectionError as error:
+                if last_attempt:
+                    raise
+                logger.warning("%s %s failed (%s), retrying", method, path, error)
+
+            else:
+                if response.status not in RETRY_STATUSES or last_attempt:
+                    break
+                response.release()
+                logger.warning(
+                    "%s %s answered %d, retrying", method, path, response.status
+                )
+
+            stats.retries += 1
+            await sleep(_backoff(attempt))
+
+        assert response
+        if response.status >= 500 or response.status in AUTH_STATUSES:
+            raise UpstreamUnavailable()
+        if response.status == 429:
+            raise RateLimited("upstream", _retry_after(response))
+        if response.status >= 400:
+            raise UpstreamRejected(response.status)
+
+        yield response
+
+    except (ClientConnectionError, TimeoutError) as error:
+        stats.errors += 1
+        outcome = "error"
+        raise UpstreamUnavailable() from error
+
+    except (UpstreamUnavailable, RateLimited):
+        stats.errors += 1
+        outcome = "error"
+        raise
+
+    except CancelledError:
+        outcome = "cancelled"
+        raise
+
+    except Exception:
+        outcome = "error"
+        raise
+
+    finally:
+        if response:
+            response.release()
+        dispatcher.release()
+        elapsed = perf_counter() - started_at
+        stats.seconds_total += elapsed
+        stats.seconds_max = max(stats.seconds_max, elapsed)
+        upstream_request_duration.observe(kind, model, outcome, value=elapsed)
+
+
+def upstream_stats() -> dict[str, UpstreamCallStats]:
+    return {kind: stats.model_copy() for kind, stats in _stats.items()}
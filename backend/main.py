@@ -3,9 +3,12 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from lib import metrics
 from lib.api import close, init as api_init
 from lib.db import init as db_init
+from lib.env import METRICS_ENABLED
 from routes.ai import router as ai_router
+from routes.metrics import router as metrics_router
 from routes.user import router as user_router
 
 
@@ -13,7 +16,10 @@ from routes.user import router as user_router
 async def lifespan(app: FastAPI):
     await db_init()
     await api_init()
+    if METRICS_ENABLED:
+        metrics.start()
     yield
+    await metrics.stop()
     await close()
 
 app = FastAPI(
@@ -26,6 +32,9 @@ app = FastAPI(
 
 app.include_router(ai_router)
 app.include_router(user_router)
+if METRICS_ENABLED:
+    app.include_router(metrics_router)
+    app.add_middleware(metrics.MetricsMiddleware)
 
 origins = ["*"]
 app.add_middleware(
@@ -34,4 +43,5 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor", "Retry-After"],
 )
\ No newline at end of file
@@ -0,0 +1,26 @@
+import asyncio
+import logging
+import sys
+
+from lib.db import engine
+from lib.migrations import migrate
+from lib.query_plans import check_query_plans
+
+
+async def main(command: str) -> int:
+    async with engine.begin() as conn:
+        version = await conn.run_sync(migrate)
+        print(f"schema version {version}")
+
+        if command == "check":
+            problems = await conn.run_sync(check_query_plans)
+            for problem in problems:
+                print(problem)
+            return 1 if problems else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(sys.argv[1] if sys.argv.__len__() > 1 else "")))
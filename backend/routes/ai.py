@@ -1,34 +1,69 @@
-from typing import Annotated, Awaitable, Callable, TypeVar
+import hashlib
+import json
+from datetime import date
+from math import ceil
+from typing import Annotated, AsyncGenerator, Awaitable, Callable, Literal, TypeVar
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
+from fastapi.responses import Response, StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from lib.api import (
+    ConversationTitle,
     CreateConversationRequest,
     CreateConversationResponse,
     SendPromptRequest,
     SendPromptResponse,
+    StreamEvent,
     create_conversation,
+    prompt_priority,
     send_prompt,
+    stream_conversation,
+    stream_prompt,
+    title_pending,
+    wait_title,
 )
+from lib.catalog import model_catalog
 from lib.db import (
+    ConversationSummary,
     DBConversation,
+    ExportedMessage,
     GetConversationResponse,
     MessageWithId,
+    UsageAggregate,
     User,
     delete_conversation,
+    export_conversation,
+    get_branch_delta,
     get_branch_info,
+    get_children,
     get_conversation,
+    get_conversation_summaries,
     get_conversations,
+    get_conversations_stamp,
     get_latest_message_of_conversation,
-    get_message,
     get_session,
+    get_usage,
     user_can_see_conversation,
     user_can_see_message,
 )
-from lib.errors import ConversationNotFound, Forbidden, MessageNotFound, ModelNotFound
-from lib.response import HTTP_EXECEPTION_MESSAGE, MESSAGE_OK
+from lib.errors import (
+    ConversationNotFound,
+    EmptyResponse,
+    Forbidden,
+    InvalidCursor,
+    MessageNotFound,
+    ModelNotFound,
+    RateLimited,
+    UpstreamBusy,
+    UpstreamRejected,
+    UpstreamUnavailable,
+    WrongModel,
+)
+from lib.limits import GenerationSlot, generation_limiter
+from lib.response import HTTP_EXECEPTION_MESSAGE, MESSAGE_OK, SSE_STREAM
 from lib.security import get_user_from_token
+from lib.upstream import BUSY_RETRY_AFTER
 
 router = APIRouter(
     prefix="/ai",
@@ -36,6 +71,9 @@ router = APIRouter(
     responses={
         404: HTTP_EXECEPTION_MESSAGE("<model | message | conservation> not found"),
         403: HTTP_EXECEPTION_MESSAGE("you cannot access this message or conversation"),
+        429: HTTP_EXECEPTION_MESSAGE("too many requests"),
+        502: HTTP_EXECEPTION_MESSAGE("upstream unavailable"),
+        503: HTTP_EXECEPTION_MESSAGE("upstream busy"),
     },
 )
 
@@ -80,48 +118,300 @@ async def raise_if_error(
             },
         )
 
+    except UpstreamBusy:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail={
+                "message": "upstream busy",
+            },
+            headers={"Retry-After": str(ceil(BUSY_RETRY_AFTER))},
+        )
+
+    except UpstreamRejected as error:
+        raise HTTPException(
+            status_code=error.status,
+            detail={
+                "message": "upstream rejected the request",
+            },
+        )
+
+    except UpstreamUnavailable:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail={
+                "message": "upstream unavailable",
+            },
+        )
+
+    except RateLimited as error:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail={
+                "message": "too many requests",
+                "reason": error.reason,
+            },
+            headers={"Retry-After": str(ceil(error.retry_after))},
+        )
+
+    except InvalidCursor:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail={
+                "message": "invalid cursor",
+            },
+        )
+
+
+_stream_error_messages: dict[type[Exception], str] = {
+    ModelNotFound: "model not found",
+    MessageNotFound: "message not found",
+    ConversationNotFound: "conservation not found",
+    Forbidden: "you cannot access this message or conversation",
+    WrongModel: "upstream answered with another model",
+    EmptyResponse: "upstream returned an empty response",
+    UpstreamBusy: "upstream busy",
+    UpstreamRejected: "upstream rejected the request",
+    UpstreamUnavailable: "upstream unavailable",
+    RateLimited: "too many requests",
+}
+
+
+def _sse(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+async def sse_stream(
+    events: AsyncGenerator[StreamEvent, None],
+) -> AsyncGenerator[str, None]:
+    """
+    Format `(event, payload)` pairs as Server-Sent Events. Errors raised after
+    the response has started are sent as an `error` event.
+    """
+    try:
+        async for event, payload in events:
+            yield _sse(event, payload.model_dump_json())
+
+    except tuple(_stream_error_messages) as error:
+        yield _sse(
+            "error", json.dumps({"message": _stream_error_messages[type(error)]})
+        )
+        return
+
+    yield _sse("done", "{}")
+
+
+class SlotStreamingResponse(StreamingResponse):
+    """
+    Holds a generation slot until the response is over, however it ends. The
+    body may never be iterated (client gone before the headers were sent), so
+    the slot cannot be released from the body itself.
+    """
+
+    def __init__(self, *args, slot: GenerationSlot | None = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+
+        finally:
+            if self.slot:
+                self.slot.release()
+
+
+def streaming_response(
+    events: AsyncGenerator[StreamEvent, None], slot: GenerationSlot | None = None
+):
+    return SlotStreamingResponse(
+        sse_stream(events),
+        slot=slot,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def make_etag(*stamp: object) -> str:
+    """Strong ETag from a version stamp, the cheap data a response depends on."""
+    return f'"{hashlib.sha1(repr(stamp).encode()).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def not_modified(etag: str, cache_control: str = "private, no-cache") -> Response:
+    return Response(
+        status_code=status.HTTP_304_NOT_MODIFIED,
+        headers={"ETag": etag, "Cache-Control": cache_control},
+    )
+
+
+def set_etag(
+    response: Response, etag: str, cache_control: str = "private, no-cache"
+) -> None:
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = cache_control
+
 
 @router.get(
     "/models", description="Get available models", responses={200: {"model": list[str]}}
 )
-async def get_models():
-    from lib.api import model_list
+async def get_models(
+    if_none_match: Annotated[str | None, Header()] = None,
+):
+    if etag_matches(if_none_match, model_catalog.etag):
+        return not_modified(model_catalog.etag, "no-cache")
 
-    return model_list
+    return Response(
+        content=model_catalog.body,
+        media_type="application/json",
+        headers={"ETag": model_catalog.etag, "Cache-Control": "no-cache"},
+    )
 
 
 @router.get(
     "/conversations",
-    description="Get all conversations",
-    responses={200: {"model": list[DBConversation]}},
+    description="Get conversations, newest first. With `limit`, the cursor of "
+    "the next page is sent in the `X-Next-Cursor` header",
+    responses={
+        200: {"model": list[DBConversation]},
+        400: HTTP_EXECEPTION_MESSAGE("invalid cursor"),
+    },
 )
 async def get_conversations_api(
     user: Annotated[User, Depends(get_user_from_token)],
     session: Annotated[AsyncSession, Depends(get_session)],
+    response: Response,
+    limit: Annotated[int | None, Query(ge=1, le=200)] = None,
+    cursor: str | None = None,
+    title_prefix: str | None = None,
+    if_none_match: Annotated[str | None, Header()] = None,
+):
+    stamp = await get_conversations_stamp(user, session)
+    etag = make_etag("conversations", user.id, stamp, limit, cursor, title_prefix)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    set_etag(response, etag)
+    page = await raise_if_error(
+        get_conversations,
+        user=user,
+        limit=limit,
+        cursor=cursor,
+        title_prefix=title_prefix,
+        session=session,
+    )
+    if page.next_cursor:
+        response.headers["X-Next-Cursor"] = page.next_cursor
+    return page.conversations
+
+
+@router.get(
+    "/conversations/summary",
+    description="Get conversations with their last activity, recently active "
+    "first. Paged like `/conversations`",
+    responses={
+        200: {"model": list[ConversationSummary]},
+        400: HTTP_EXECEPTION_MESSAGE("invalid cursor"),
+    },
+)
+async def get_conversation_summaries_api(
+    user: Annotated[User, Depends(get_user_from_token)],
+    session: Annotated[AsyncSession, Depends(get_session)],
+    response: Response,
+    limit: Annotated[int | None, Query(ge=1, le=200)] = None,
+    cursor: str | None = None,
+    if_none_match: Annotated[str | None, Header()] = None,
 ):
-    return await raise_if_error(get_conversations, user=user, session=session)
+    stamp = await get_conversations_stamp(user, session)
+    etag = make_etag("summary", user.id, stamp, limit, cursor)
+    if etag_matches(if_none_match, etag):
+        return not_modified(etag)
+
+    set_etag(response, etag)
+    page = await raise_if_error(
+        get_conversation_summaries,
+        user=user,
+        limit=limit,
+        cursor=cursor,
+        session=session,
+    )
+    if page.next_cursor:
+        response.headers["X-Next-Cursor"] = page.next_cursor
+    return page.conversations
 
 
 @router.get(
     "/conversation",
-    description="Get all messages in a conversation",
+    description="Get all messages in a conversation. With `since` (a message id "
+    "the client already has), only the messages after it are sent, if it is "
+    "still on the branch",
     responses={200: {"model": list[GetConversationResponse]}},
 )
 async def get_conversation_api(
     id: str,
     user: Annotated[User, Depends(get_user_from_token)],
     session: Annotated[AsyncSession, Depends(get_session)],
+    response: Response,
     message: str | None = None,
+    since: str | None = None,
+    if_none_match: Annotated[str | None, Header()] = None,
 ):
     async def _iner():
-        await user_can_see_conversation(user.id, id, session)
-        conversation = await get_conversation(id, session)
+        conversation = await user_can_see_conversation(user.id, id, session)
+        pending = title_pending(id)
+        etag = make_etag(id, conversation.version, pending, message, since)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+
         latest_message = await get_latest_message_of_conversation(id, message, session)
-        return GetConversationResponse(
+        result = GetConversationResponse(
             model_id=conversation.model_id,
             title=conversation.title,
-            messages=await get_branch_info(latest_message.id, session)
+            messages=[],
+            title_pending=pending,
+        )
+        delta = (
+            await get_branch_delta(latest_message.id, since, session)
+            if since
+            else None
         )
+        if delta:
+            result.messages = delta.messages
+            result.branches = delta.branches
+            result.partial = True
+        else:
+            result.messages = await get_branch_info(latest_message.id, session)
+        set_etag(response, etag)
+        return result
+
+    return await raise_if_error(_iner)
+
+
+@router.get(
+    "/conversation/title",
+    description="Get the title of a conversation. If the title is still being "
+    "generated, wait up to `wait` seconds for it",
+    responses={200: {"model": ConversationTitle}},
+)
+async def get_conversation_title_api(
+    id: str,
+    user: Annotated[User, Depends(get_user_from_token)],
+    wait: Annotated[float, Query(ge=0, le=30)] = 0,
+):
+    # No request session: it would keep a pooled connection for the whole wait
+    async def _iner():
+        conversation = await user_can_see_conversation(user.id, id)
+        title = await wait_title(id, wait) if wait else None
+        if title is None:
+            if wait:
+                conversation = await get_conversation(id)
+            title = conversation.title
+        return ConversationTitle(id=id, title=title, pending=title_pending(id))
 
     return await raise_if_error(_iner)
 
@@ -135,11 +425,17 @@ async def get_children_api(
     id: str,
     user: Annotated[User, Depends(get_user_from_token)],
     session: Annotated[AsyncSession, Depends(get_session)],
+    response: Response,
+    if_none_match: Annotated[str | None, Header()] = None,
 ):
     async def _iner():
-        await user_can_see_message(user.id, id, session)
-        message = await get_message(id, session)
-        return [MessageWithId(**child.model_dump()) for child in message.children]
+        parent = await user_can_see_message(user.id, id, session)
+        etag = make_etag(id, parent.conversation.version)
+        if etag_matches(if_none_match, etag):
+            return not_modified(etag)
+
+        set_etag(response, etag)
+        return await get_children(id, session)
 
     return await raise_if_error(_iner)
 
@@ -156,13 +452,20 @@ async def new_conversation_api(
 ):
     model_id = body.model_id
     message = body.content
-    return await raise_if_error(
-        create_conversation,
-        user_id=user.id,
-        model_id=model_id,
-        message=message,
-        session=session,
-    )
+
+    async def _iner():
+        if model_id not in model_catalog:
+            raise ModelNotFound()
+        with generation_limiter.acquire(user.id, model_id):
+            return await create_conversation(
+                user_id=user.id,
+                model_id=model_id,
+                message=message,
+                session=session,
+                cache=body.cache,
+            )
+
+    return await raise_if_error(_iner)
 
 
 @router.post(
@@ -179,12 +482,109 @@ async def send_prompt_api(
     new_message = body.content
 
     async def _iner():
-        await user_can_see_message(user.id, previous_message_id, session)
-        return await send_prompt(previous_message_id, new_message, session)
+        previous_message = await user_can_see_message(
+            user.id, previous_message_id, session
+        )
+        model_id = previous_message.conversation.model_id
+        with generation_limiter.acquire(user.id, model_id):
+            return await send_prompt(
+                previous_message,
+                new_message,
+                session,
+                await prompt_priority(previous_message, session),
+                body.cache,
+            )
+
+    return await raise_if_error(_iner)
+
+
+@router.post(
+    "/conversation/stream",
+    description="Create a new conversation and stream the first answer as SSE",
+    responses={200: SSE_STREAM()},
+)
+async def new_conversation_stream_api(
+    user: Annotated[User, Depends(get_user_from_token)],
+    body: CreateConversationRequest,
+):
+    model_id = body.model_id
+    message = body.content
+
+    async def _iner():
+        if model_id not in model_catalog:
+            raise ModelNotFound()
+        slot = generation_limiter.acquire(user.id, model_id)
+        return streaming_response(
+            stream_conversation(user.id, model_id, message, body.cache), slot
+        )
+
+    return await raise_if_error(_iner)
+
+
+@router.post(
+    "/prompt/stream",
+    description="Send new follow up message and stream the answer as SSE",
+    responses={200: SSE_STREAM()},
+)
+async def send_prompt_stream_api(
+    user: Annotated[User, Depends(get_user_from_token)],
+    body: SendPromptRequest,
+    session: Annotated[AsyncSession, Depends(get_session)],
+):
+    previous_message_id = body.message_id
+    new_message = body.content
+
+    async def _iner():
+        previous_message = await user_can_see_message(
+            user.id, previous_message_id, session
+        )
+        priority = await prompt_priority(previous_message, session)
+        slot = generation_limiter.acquire(
+            user.id, previous_message.conversation.model_id
+        )
+        return streaming_response(
+            stream_prompt(
+                previous_message,
+                new_message,
+                priority,
+                body.cache,
+            ),
+            slot,
+        )
 
     return await raise_if_error(_iner)
 
 
+async def ndjson_stream(
+    messages: AsyncGenerator[ExportedMessage, None], reasoning: bool
+) -> AsyncGenerator[str, None]:
+    exclude = None if reasoning else {"reasoning"}
+    async for message in messages:
+        yield message.model_dump_json(exclude=exclude) + "\n"
+
+
+@router.get(
+    "/conversation/export",
+    description="Stream every message of a conversation as NDJSON, one message "
+    "per line, parents before their children",
+    responses={
+        200: {"model": ExportedMessage, "content": {"application/x-ndjson": {}}}
+    },
+)
+async def export_conversation_api(
+    id: str,
+    user: Annotated[User, Depends(get_user_from_token)],
+    session: Annotated[AsyncSession, Depends(get_session)],
+    reasoning: bool = False,
+):
+    await raise_if_error(user_can_see_conversation, user.id, id, session)
+    return StreamingResponse(
+        ndjson_stream(export_conversation(id, reasoning), reasoning),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{id}.ndjson"'},
+    )
+
+
 @router.delete(
     "/conversation", description="Delete a conversation", responses={200: MESSAGE_OK()}
 )
@@ -199,3 +599,22 @@ async def delete_conversation_api(
         return {"message": "ok"}
 
     return await raise_if_error(_iner)
+
+
+@router.get(
+    "/usage",
+    description="Your upstream usage (requests, tokens and upstream timings) per "
+    "UTC day, summed by `group_by` (`day`, `model`, `kind`) between `since` and "
+    "`until` (the last 30 days by default)",
+    responses={200: {"model": list[UsageAggregate]}},
+)
+async def get_usage_api(
+    user: Annotated[User, Depends(get_user_from_token)],
+    session: Annotated[AsyncSession, Depends(get_session)],
+    group_by: Annotated[
+        list[Literal["day", "model", "kind"]], Query()
+    ] = ["day", "model"],
+    since: date | None = None,
+    until: date | None = None,
+):
+    return await get_usage(group_by, since, until, user.id, session)
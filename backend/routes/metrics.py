@@ -0,0 +1,146 @@
+import hmac
+from datetime import date
+from typing import Annotated, Iterable, Literal
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, status
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from lib.api import context_cache
+from lib.cache import LRUCache
+from lib.completions import completion_cache
+from lib.db import UsageAggregate, get_session, get_usage, pool_stats, user_cache
+from lib.env import METRICS_TOKEN
+from lib.hash import hash_stats
+from lib.limits import generation_limiter
+from lib.metrics import Counter, Gauge, Metric, registry
+from lib.upstream import dispatcher, upstream_stats
+
+router = APIRouter(tags=["metrics"])
+
+CACHES: dict[str, LRUCache] = {
+    "context": context_cache,
+    "user": user_cache,
+    "rate_limit": generation_limiter.buckets,
+    "completion": completion_cache,
+}
+
+
+def _snapshot() -> Iterable[Metric]:
+    """Numbers the app keeps anyway, read when scraped."""
+    pool = pool_stats()
+    pool_gauge = Gauge("db_pool_connections", "Database pool connections", ("state",))
+    pool_gauge.set("size", value=pool.size)
+    pool_gauge.set("checked_out", value=pool.checked_out)
+    pool_gauge.set("overflow", value=max(pool.overflow, 0))
+    pool_checkouts = Counter("db_pool_checkouts_total", "Connections checked out")
+    pool_checkouts.inc(amount=pool.checkouts)
+    pool_wait = Counter(
+        "db_pool_wait_seconds_total", "Time spent waiting for a free connection"
+    )
+    pool_wait.inc(amount=pool.wait_seconds_total)
+    yield from (pool_gauge, pool_checkouts, pool_wait)
+
+    hashing = hash_stats()
+    hash_jobs = Gauge("hash_jobs", "Password hash jobs", ("state",))
+    hash_jobs.set("queued", value=hashing.queued)
+    hash_jobs.set("running", value=hashing.running)
+    hash_completed = Counter("hash_jobs_completed_total", "Password hash jobs done")
+    hash_completed.inc(amount=hashing.completed)
+    hash_seconds = Counter(
+        "hash_seconds_total", "Time hash jobs spent waiting / running", ("phase",)
+    )
+    hash_seconds.inc("wait", amount=hashing.wait_seconds_total)
+    hash_seconds.inc("run", amount=hashing.run_seconds_total)
+    yield from (hash_jobs, hash_completed, hash_seconds)
+
+    cache_events = Counter(
+        "cache_events_total", "In-process cache lookups and drops", ("cache", "event")
+    )
+    cache_size = Gauge("cache_size", "In-process cache size", ("cache", "unit"))
+    for name, cache in CACHES.items():
+        stats = cache.stats()
+        cache_events.inc(name, "hit", amount=stats.hits)
+        cache_events.inc(name, "miss", amount=stats.misses)
+        cache_events.inc(name, "eviction", amount=stats.evictions)
+        cache_events.inc(name, "expiration", amount=stats.expirations)
+        cache_size.set(name, "items", value=stats.items)
+        cache_size.set(name, "bytes", value=stats.bytes)
+    yield from (cache_events, cache_size)
+
+    upstream_calls = Counter(
+        "upstream_calls_total", "Upstream calls by kind and result", ("kind", "result")
+    )
+    for kind, stats in upstream_stats().items():
+        upstream_calls.inc(kind, "call", amount=stats.calls)
+        upstream_calls.inc(kind, "error", amount=stats.errors)
+        upstream_calls.inc(kind, "retry", amount=stats.retries)
+    yield upstream_calls
+
+    dispatch = dispatcher.stats()
+    dispatch_running = Gauge(
+        "upstream_dispatch_running", "Upstream calls holding a dispatcher slot"
+    )
+    dispatch_running.set(value=dispatch.running)
+    dispatch_queued = Gauge(
+        "upstream_dispatch_queued", "Upstream calls waiting for a slot", ("priority",)
+    )
+    for priority, count in dispatch.queued.items():
+        dispatch_queued.set(priority, value=count)
+    yield from (dispatch_running, dispatch_queued)
+
+    generations = Gauge("generations_running", "Answers being generated", ("model",))
+    for model_id, count in generation_limiter.running_per_model.items():
+        generations.set(model_id, value=count)
+    yield generations
+
+
+def check_metrics_token(authorization: Annotated[str | None, Header()] = None):
+    if METRICS_TOKEN and not hmac.compare_digest(
+        authorization or "", f"Bearer {METRICS_TOKEN}"
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail={"message": "wrong metrics token"},
+        )
+
+
+def require_metrics_token(authorization: Annotated[str | None, Header()] = None):
+    """Same as `check_metrics_token`, but hidden when no token is set."""
+    if not METRICS_TOKEN:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail={"message": "not found"},
+        )
+    check_metrics_token(authorization)
+
+
+@router.get(
+    "/metrics",
+    include_in_schema=False,
+    dependencies=[Depends(check_metrics_token)],
+)
+async def get_metrics():
+    return PlainTextResponse(
+        registry.render(_snapshot()),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+@router.get(
+    "/metrics/usage",
+    description="Upstream usage of every user, summed by `group_by` (`day`, "
+    "`user`, `model`, `kind`) between `since` and `until` (the last 30 days by "
+    "default). Same token as `/metrics`, answers 404 when none is set",
+    responses={200: {"model": list[UsageAggregate]}},
+    dependencies=[Depends(require_metrics_token)],
+)
+async def get_usage_metrics(
+    session: Annotated[AsyncSession, Depends(get_session)],
+    group_by: Annotated[
+        list[Literal["day", "user", "model", "kind"]], Query()
+    ] = ["model"],
+    since: date | None = None,
+    until: date | None = None,
+):
+    return await get_usage(group_by, since, until, session=session)